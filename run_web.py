@@ -5,17 +5,15 @@ Launcher script for Matilda web interface
 
 import os
 import sys
+import importlib.util
 from pathlib import Path
 
-# Add web directory to Python path
-web_dir = Path(__file__).parent / "web"
-sys.path.append(str(web_dir))
+root_dir = Path(__file__).parent
 
-# Import app from web module
-try:
-    from app import app
-except ImportError as e:
-    print(f"Error: {e}")
+# Check the web app and Flask are importable without importing them here
+missing = [name for name in ("flask", "web.app") if importlib.util.find_spec(name) is None]
+if missing:
+    print(f"Error: No module named '{missing[0]}'")
     print("Make sure you have installed the required dependencies:")
     print("pip install -r requirements.txt")
     sys.exit(1)
@@ -25,12 +23,22 @@ if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
     
-    print("\n" + "=" * 70)
-    print(f"MATILDA - Web Interface")
-    print("=" * 70)
-    print(f"\nOpen your browser and navigate to: http://localhost:{port}")
-    print("\nPress Ctrl+C to exit")
-    print("=" * 70 + "\n")
+    banner = (
+        "\n" + "=" * 70 + "\n"
+        "MATILDA - Web Interface\n"
+        + "=" * 70 + "\n"
+        f"\nOpen your browser and navigate to: http://localhost:{port}\n"
+        "\nPress Ctrl+C to exit\n"
+        + "=" * 70 + "\n\n"
+    )
+    sys.stdout.write(banner)
+    sys.stdout.flush()
     
-    app.run(host='0.0.0.0', port=port, debug=debug)
-
+    # Replace this launcher process with the Flask CLI so none of its state stays resident
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        p for p in (str(root_dir), os.environ.get("PYTHONPATH")) if p
+    )
+    flask_args = [sys.executable, "-m", "flask", "--app", "web.app", "run", "--host=0.0.0.0", f"--port={port}"]
+    if debug:
+        flask_args.append("--debug")
+    os.execv(sys.executable, flask_args)
@@ -14,6 +14,8 @@ import sys
 import platform
 import subprocess
 import shutil
+import hashlib
+import runpy
 import venv
 from pathlib import Path
 
@@ -29,29 +31,53 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+# Drop escape sequences when output is piped or NO_COLOR is set
+if not sys.stdout.isatty() or os.environ.get("NO_COLOR"):
+    for attr in list(vars(Colors)):
+        if not attr.startswith("_") and isinstance(getattr(Colors, attr), str):
+            setattr(Colors, attr, "")
+
+# Platform facts, probed once at import
+_IS_WINDOWS = platform.system() == "Windows"
+_PY_VERSION_TUPLE = sys.version_info[:2]
+_PY_VERSION_STR = platform.python_version()
+
+# Project paths, relative to the directory setup is run from
+_REQ = Path("requirements.txt")
+_VENV = Path("venv")
+_ENV = Path(".env")
+_ENV_EX = Path(".env.example")
+_TEST = Path("tests") / "test_connection.py"
+
+# Wheels downloaded in the background while the virtual environment is created
+PREFETCH_DIR = Path.home() / ".cache" / "pip" / "matilda_prefetch"
+
 def print_color(text, color):
     """Print colored text to the terminal"""
-    print(f"{color}{text}{Colors.ENDC}")
+    sys.stdout.write("".join((color, text, Colors.ENDC, "\n")))
+
+def print_block(lines):
+    """Print several (text, color) lines to the terminal with a single write"""
+    sys.stdout.write("".join("".join((color, text, Colors.ENDC, "\n")) for text, color in lines))
+    sys.stdout.flush()
 
 def check_python_version():
     """Check if Python version is 3.9 or higher"""
     print_color("Checking Python version...", Colors.HEADER)
     
-    major, minor, *_ = sys.version_info
-    
-    if major < 3 or (major == 3 and minor < 9):
+    if _PY_VERSION_TUPLE < (3, 9):
         print_color("Error: Python 3.9 or higher is required.", Colors.RED)
-        print_color(f"Current Python version: {platform.python_version()}", Colors.RED)
+        print_color(f"Current Python version: {_PY_VERSION_STR}", Colors.RED)
         sys.exit(1)
     
-    print_color(f"✓ Python version {platform.python_version()} detected", Colors.GREEN)
+    print_color(f"✓ Python version {_PY_VERSION_STR} detected", Colors.GREEN)
     return True
 
 def setup_virtual_environment():
     """Set up a virtual environment if it doesn't exist"""
     print_color("\nSetting up virtual environment...", Colors.HEADER)
     
-    venv_dir = Path("venv")
+    venv_dir = _VENV
     
     if venv_dir.exists():
         print_color("✓ Virtual environment already exists", Colors.GREEN)
@@ -59,7 +85,9 @@ def setup_virtual_environment():
     
     print_color("Creating virtual environment...", Colors.CYAN)
     try:
-        venv.create(venv_dir, with_pip=True)
+        # Skip the pip bootstrap here; ensure_pip() installs it only when it is needed
+        builder = venv.EnvBuilder(with_pip=False, symlinks=not _IS_WINDOWS, clear=False)
+        builder.create(str(venv_dir))
         print_color("✓ Virtual environment created successfully", Colors.GREEN)
     except Exception as e:
         print_color(f"Error creating virtual environment: {str(e)}", Colors.RED)
@@ -69,32 +97,116 @@ def setup_virtual_environment():
 
 def get_venv_python_path(venv_dir):
     """Get the path to the Python executable in the virtual environment"""
-    if platform.system() == "Windows":
+    if _IS_WINDOWS:
         return venv_dir / "Scripts" / "python.exe"
     return venv_dir / "bin" / "python"
 
-def install_dependencies(venv_python):
+def run_forwarding_output(cmd):
+    """Run a command, forwarding its combined output to stdout in large chunks"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=65536)
+    with proc.stdout:
+        # read1 returns whatever is available, so output stays live without tiny writes
+        for chunk in iter(lambda: proc.stdout.read1(65536), b""):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+    returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def ensure_pip(venv_python):
+    """Bootstrap pip into the virtual environment if it is missing"""
+    has_pip = subprocess.run(
+        [str(venv_python), "-c", "import pip"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    ).returncode == 0
+    if has_pip:
+        return True
+    
+    print_color("Bootstrapping pip...", Colors.CYAN)
+    try:
+        subprocess.run([str(venv_python), "-m", "ensurepip", "--default-pip", "--upgrade"], check=True)
+    except subprocess.CalledProcessError as e:
+        print_color(f"Error bootstrapping pip: {str(e)}", Colors.RED)
+        return False
+    
+    return True
+
+def requirements_hash():
+    """Return the sha256 of requirements.txt, or None if it is missing"""
+    requirements_file = _REQ
+    if not requirements_file.exists():
+        return None
+    return hashlib.sha256(requirements_file.read_bytes()).hexdigest()
+
+def dependencies_up_to_date(venv_dir):
+    """Check whether the venv was installed from the current requirements.txt"""
+    reqs_hash = requirements_hash()
+    hash_file = venv_dir / ".matilda_reqs_hash"
+    return reqs_hash is not None and hash_file.exists() and hash_file.read_text().strip() == reqs_hash
+
+def start_wheel_prefetch(venv_dir):
+    """Start downloading wheels in the background so pip install finds them locally"""
+    # uv has its own parallel downloader, and there is nothing to fetch if the venv is current
+    if shutil.which("uv") or requirements_hash() is None or dependencies_up_to_date(venv_dir):
+        return None
+    
+    return subprocess.Popen(
+        [sys.executable, "-m", "pip", "download", "--quiet", "--prefer-binary", "--no-deps",
+         "-r", str(_REQ), "-d", str(PREFETCH_DIR)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+def install_dependencies(venv_python, venv_dir, prefetch=None):
     """Install dependencies from requirements.txt"""
     print_color("\nInstalling dependencies...", Colors.HEADER)
     
-    requirements_file = Path("requirements.txt")
-    if not requirements_file.exists():
+    reqs_hash = requirements_hash()
+    if reqs_hash is None:
         print_color("Error: requirements.txt not found", Colors.RED)
         sys.exit(1)
     
+    # Skip pip entirely if this venv was already installed from the same requirements
+    hash_file = venv_dir / ".matilda_reqs_hash"
+    if dependencies_up_to_date(venv_dir):
+        print_color("✓ Dependencies up-to-date", Colors.GREEN)
+        return True
+    
     print_color("Installing packages from requirements.txt...", Colors.CYAN)
     print_color("This might take a few minutes...", Colors.YELLOW)
     
+    # Prefer uv when available: it resolves and installs the whole file in one batch
+    uv = shutil.which("uv")
+    if uv:
+        install_cmd = [uv, "pip", "install", "--python", str(venv_python), "-r", str(_REQ)]
+    else:
+        if not ensure_pip(venv_python):
+            return False
+        # Let pip reuse its wheel cache and avoid source builds where a wheel exists
+        install_cmd = [str(venv_python), "-m", "pip", "install", "--prefer-binary", "--progress-bar", "off", "--timeout", "120", "-r", str(_REQ)]
+        
+        # Use the wheels downloaded while the venv was being created, if that worked
+        if prefetch is not None:
+            try:
+                if prefetch.wait() == 0:
+                    install_cmd += ["--find-links", str(PREFETCH_DIR)]
+            except Exception:
+                pass
+    
     try:
-        # Use --no-cache-dir to avoid cache issues and increase timeout
-        subprocess.run(
-            [str(venv_python), "-m", "pip", "install", "--no-cache-dir", "--timeout", "120", "-r", "requirements.txt"],
-            check=True
-        )
+        sys.stdout.flush()
+        run_forwarding_output(install_cmd)
         print_color("✓ Dependencies installed successfully", Colors.GREEN)
+        hash_file.write_text(reqs_hash)
     except subprocess.CalledProcessError as e:
         print_color(f"Error installing dependencies: {str(e)}", Colors.RED)
-        print_color("Try installing dependencies manually with: venv/Scripts/pip install -r requirements.txt", Colors.YELLOW)
+        # A uv-created venv may have no pip in it, so point at the tool that was actually used
+        if uv:
+            manual_cmd = f"{uv} pip install --python {venv_python} -r requirements.txt"
+        else:
+            manual_cmd = f"{venv_python} -m pip install -r requirements.txt"
+        print_color(f"Try installing dependencies manually with: {manual_cmd}", Colors.YELLOW)
         return False
     
     return True
@@ -103,8 +215,8 @@ def setup_env_file():
     """Guide user through creating their .env file"""
     print_color("\nSetting up environment variables...", Colors.HEADER)
     
-    env_file = Path(".env")
-    env_example = Path(".env.example")
+    env_file = _ENV
+    env_example = _ENV_EX
     
     if env_file.exists():
         overwrite = input("A .env file already exists. Overwrite it? (y/n): ").lower() == 'y'
@@ -116,9 +228,8 @@ def setup_env_file():
         print_color("Error: .env.example file not found", Colors.RED)
         return False
     
-    # Copy example file to .env
-    shutil.copy(env_example, env_file)
-    print_color(".env file created from template", Colors.CYAN)
+    # Read the template once; all substitutions happen in memory
+    env_content = env_example.read_text()
     
     # Get Together.ai API key
     print_color("\nTo use MATILDA, you need a Together.ai API key.", Colors.YELLOW)
@@ -127,36 +238,26 @@ def setup_env_file():
     api_key = input("\nEnter your Together.ai API key (or press Enter to add it later): ").strip()
     
     if api_key:
-        # Read current .env file
-        with open(env_file, 'r') as f:
-            env_content = f.read()
-        
         # Replace API key placeholder
         env_content = env_content.replace("TOGETHER_API_KEY=your_together_api_key_here", f"TOGETHER_API_KEY={api_key}")
-        
-        # Write updated content
-        with open(env_file, 'w') as f:
-            f.write(env_content)
-        
-        print_color("✓ API key added to .env file", Colors.GREEN)
-    else:
-        print_color("No API key provided. You'll need to add it manually to the .env file later.", Colors.YELLOW)
     
     # Customize username
     username = input("\nEnter your preferred name (or press Enter to use 'User'): ").strip()
     
     if username:
-        # Read current .env file
-        with open(env_file, 'r') as f:
-            env_content = f.read()
-        
         # Replace username placeholder
         env_content = env_content.replace("USERNAME=User", f"USERNAME={username}")
-        
-        # Write updated content
-        with open(env_file, 'w') as f:
-            f.write(env_content)
-        
+    
+    # Write the finished file in one go
+    env_file.write_text(env_content)
+    print_color(".env file created from template", Colors.CYAN)
+    
+    if api_key:
+        print_color("✓ API key added to .env file", Colors.GREEN)
+    else:
+        print_color("No API key provided. You'll need to add it manually to the .env file later.", Colors.YELLOW)
+    
+    if username:
         print_color(f"✓ Username set to '{username}'", Colors.GREEN)
     
     print_color("\n✓ Environment setup complete", Colors.GREEN)
@@ -168,14 +269,25 @@ def run_connection_test(venv_python):
     """Run the connection test script"""
     print_color("\nRunning connection test...", Colors.HEADER)
     
-    test_script = Path("tests") / "test_connection.py"
+    test_script = _TEST
     if not test_script.exists():
         print_color("Error: Connection test script not found", Colors.RED)
         return False
     
+    # When setup is already running inside the venv, run the test in this interpreter
+    venv_dir = venv_python.parent.parent
+    in_venv = Path(sys.prefix).resolve() == venv_dir.resolve()
+    
     try:
         print_color("\n" + "=" * 70, Colors.CYAN)
-        subprocess.run([str(venv_python), str(test_script)], check=True)
+        if in_venv:
+            try:
+                runpy.run_path(str(test_script), run_name="__main__")
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise subprocess.CalledProcessError(e.code, str(test_script))
+        else:
+            subprocess.run([str(venv_python), str(test_script)], check=True)
         print_color("=" * 70, Colors.CYAN)
         return True
     except subprocess.CalledProcessError:
@@ -186,26 +298,38 @@ def activate_instructions():
     """Show instructions for activating the virtual environment"""
     print_color("\nTo activate the virtual environment:", Colors.HEADER)
     
-    if platform.system() == "Windows":
+    if _IS_WINDOWS:
         print_color("Run: .\\venv\\Scripts\\activate", Colors.CYAN)
     else:
         print_color("Run: source venv/bin/activate", Colors.CYAN)
 
 def main():
     """Main setup function"""
-    print_color("\n" + "=" * 70, Colors.BLUE)
-    print_color("MATILDA - Setup Assistant", Colors.BOLD + Colors.BLUE)
-    print_color("=" * 70, Colors.BLUE)
+    print_block([
+        ("\n" + "=" * 70, Colors.BLUE),
+        ("MATILDA - Setup Assistant", Colors.BOLD + Colors.BLUE),
+        ("=" * 70, Colors.BLUE),
+    ])
     
     # Check Python version
     check_python_version()
     
-    # Setup virtual environment
-    venv_dir = setup_virtual_environment()
-    venv_python = get_venv_python_path(venv_dir)
-    
-    # Install dependencies
-    if not install_dependencies(venv_python):
+    # Download wheels (network) while the venv is created (filesystem)
+    prefetch = start_wheel_prefetch(_VENV)
+    try:
+        # Setup virtual environment
+        venv_dir = setup_virtual_environment()
+        venv_python = get_venv_python_path(venv_dir)
+        
+        # Install dependencies
+        installed = install_dependencies(venv_python, venv_dir, prefetch)
+    finally:
+        # Don't make a failed or uv-driven setup wait for a download nobody will use
+        if prefetch is not None and prefetch.poll() is None:
+            prefetch.terminate()
+            prefetch.wait()
+    
+    if not installed:
         print_color("Setup incomplete. Fix the issues above and try again.", Colors.RED)
         sys.exit(1)
     
@@ -218,21 +342,26 @@ def main():
     if run_test:
         run_connection_test(venv_python)
     else:
-        print_color("\nSkipping connection test.", Colors.YELLOW)
-        print_color("You can run it later with: python tests/test_connection.py", Colors.YELLOW)
+        print_block([
+            ("\nSkipping connection test.", Colors.YELLOW),
+            ("You can run it later with: python tests/test_connection.py", Colors.YELLOW),
+        ])
     
     # Show final instructions
-    print_color("\n" + "=" * 70, Colors.GREEN)
-    print_color("✨ MATILDA setup complete! ✨", Colors.BOLD + Colors.GREEN)
-    print_color("=" * 70, Colors.GREEN)
+    print_block([
+        ("\n" + "=" * 70, Colors.GREEN),
+        ("✨ MATILDA setup complete! ✨", Colors.BOLD + Colors.GREEN),
+        ("=" * 70, Colors.GREEN),
+    ])
     
     activate_instructions()
     
-    print_color("\nTo start MATILDA:", Colors.HEADER)
-    print_color("1. Activate the virtual environment (see above)", Colors.CYAN)
-    print_color("2. Run: python src/matilda.py", Colors.CYAN)
-    
-    print_color("\nEnjoy your personal AI assistant!", Colors.BOLD + Colors.GREEN)
+    print_block([
+        ("\nTo start MATILDA:", Colors.HEADER),
+        ("1. Activate the virtual environment (see above)", Colors.CYAN),
+        ("2. Run: python src/matilda.py", Colors.CYAN),
+        ("\nEnjoy your personal AI assistant!", Colors.BOLD + Colors.GREEN),
+    ])
 
 if __name__ == "__main__":
     main()
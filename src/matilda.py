@@ -6,16 +6,37 @@ improved conversation context, and multiple conversation styles
 """
 
 import os
+import sys
 import json
+import re
+import warnings
+import logging
 import time
 import uuid
+import atexit
 import base64
+import hashlib
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
 import datetime
 import tempfile
+import types
+import copy
+import itertools
+import threading
+import queue
+import collections
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Optional, Any, Generator, Callable, Union, Tuple, Iterator
 
+# Suppress deprecation warnings from Together API (registered once, at import)
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", message="The use of together.api_key is deprecated")
+
 # Configuration will be loaded from .env files when dotenv is available
 try:
     from dotenv import load_dotenv
@@ -23,22 +44,133 @@ try:
 except ImportError:
     print("Warning: python-dotenv not installed. Using environment variables directly.")
 
-# Rich for colorful terminal output (if available)
-try:
-    from rich.console import Console
-    from rich.markdown import Markdown
-    console = Console()
-    HAS_RICH = True
-except ImportError:
-    HAS_RICH = False
-    console = None
+# Optional heavy dependencies are imported on first use, not at module import
+
+@functools.cache
+def _get_console():
+    """Rich console for colorful terminal output, or None if rich is unavailable"""
+    try:
+        from rich.console import Console
+    except ImportError:
+        return None
+    return Console()
+
+
+def _has_rich() -> bool:
+    """Whether rich is available for terminal output"""
+    return _get_console() is not None
+
+
+@functools.cache
+def _get_together():
+    """The together package, or None if it is not installed"""
+    try:
+        import together
+    except ImportError:
+        return None
+    return together
 
-# Optional imports for image display
+
+@functools.cache
+def _get_openai():
+    """The openai package, or None if it is not installed"""
+    try:
+        import openai
+    except ImportError:
+        return None
+    return openai
+
+# Faster JSON encoding/decoding (if available); all helpers work on bytes
 try:
-    from PIL import Image
-    HAS_PIL = True
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps_pretty = lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    _json_dumps_compact = orjson.dumps
+    HAS_ORJSON = True
 except ImportError:
-    HAS_PIL = False
+    _json_loads = json.loads
+    _json_dumps_pretty = lambda obj: json.dumps(obj, indent=2).encode("utf-8")
+    # One shared encoder; non-ASCII text is written as UTF-8, matching orjson's output
+    _json_encode_compact = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    _json_dumps_compact = lambda obj: _json_encode_compact(obj).encode("utf-8")
+    HAS_ORJSON = False
+
+
+# Shared HTTP session so image API calls and downloads reuse pooled keep-alive connections
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+))
+# (connect, read) timeouts for image API calls
+HTTP_TIMEOUT = (5, 60)
+
+
+# Predefined conversation style parameters, shared read-only by every config
+_STYLE_TABLE = types.MappingProxyType({
+    "professional": {
+        "temperature": 0.6,
+        "top_p": 0.9,
+        "system_prompt_addon": (
+            "You are professional, precise, and formal in your responses. "
+            "You prioritize accuracy and clarity. "
+            "You use proper terminology and avoid casual language. "
+            "You maintain a helpful but somewhat formal tone."
+        )
+    },
+    "casual": {
+        "temperature": 0.8,
+        "top_p": 0.95,
+        "system_prompt_addon": (
+            "You are casual, friendly, and conversational in your responses. "
+            "You use relaxed language and occasional humor when appropriate. "
+            "You're warm and approachable, like chatting with a friend. "
+            "You use simpler explanations and everyday examples."
+        )
+    },
+    "balanced": {
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "system_prompt_addon": (
+            "You balance professionalism with approachability. "
+            "You adapt your tone to match the user's style and the context of the conversation. "
+            "You're helpful, clear, and friendly without being overly formal or casual."
+        )
+    },
+    "creative": {
+        "temperature": 0.9,
+        "top_p": 0.98,
+        "system_prompt_addon": (
+            "You are creative, imaginative, and engaging in your responses. "
+            "You think outside the box and offer unique perspectives and ideas. "
+            "You use vivid language, metaphors, and storytelling techniques when appropriate. "
+            "You're enthusiastic and inspirational."
+        )
+    },
+    "concise": {
+        "temperature": 0.5,
+        "top_p": 0.85,
+        "system_prompt_addon": (
+            "You are brief and to the point. "
+            "You prioritize efficiency and clarity in your responses. "
+            "You avoid unnecessary details unless specifically asked. "
+            "You use short sentences and paragraphs."
+        )
+    }
+})
+
+
+# Values accepted as "true" for boolean environment settings
+_BOOL_TRUE = frozenset({"true", "1", "yes", "on"})
+
+
+def _envbool(key: str, default: str) -> bool:
+    """Read a boolean setting from the environment"""
+    return os.environ.get(key, default).strip().lower() in _BOOL_TRUE
+
+
+def _decode_and_write(b64_data: str, filename: str):
+    """Decode a base64 image payload and write it to disk"""
+    Path(filename).write_bytes(base64.b64decode(b64_data))
 
 
 class MatildaConfig:
@@ -46,32 +178,40 @@ class MatildaConfig:
     
     def __init__(self, config_file: Optional[str] = None):
         self.config_file = config_file
+        # Callbacks notified as callback(key, value) whenever a value is set
+        self._observers: List[Callable[[str, Any], None]] = []
+        # Bumped on every set() so dependents can tell when cached values are stale
+        self.version = 0
+        env = os.environ
         self.config = {
             # API Configuration
-            "api_key": os.environ.get("TOGETHER_API_KEY", ""),
-            "model": os.environ.get("TOGETHER_MODEL", "mistralai/Mixtral-8x7B-Instruct-v0.1"),
-            "image_model": os.environ.get("IMAGE_MODEL", "stabilityai/stable-diffusion-xl-base-1.0"),
-            "max_tokens": int(os.environ.get("MAX_TOKENS", "2048")),
-            "temperature": float(os.environ.get("TEMPERATURE", "0.7")),
-            "top_p": float(os.environ.get("TOP_P", "0.9")),
-            "top_k": int(os.environ.get("TOP_K", "40")),
+            "api_key": env.get("TOGETHER_API_KEY", ""),
+            "model": env.get("TOGETHER_MODEL", "mistralai/Mixtral-8x7B-Instruct-v0.1"),
+            "image_model": env.get("IMAGE_MODEL", "stabilityai/stable-diffusion-xl-base-1.0"),
+            "max_tokens": int(env.get("MAX_TOKENS", "2048")),
+            "temperature": float(env.get("TEMPERATURE", "0.7")),
+            "top_p": float(env.get("TOP_P", "0.9")),
+            "top_k": int(env.get("TOP_K", "40")),
             
             # Conversation Settings
-            "voice_enabled": os.environ.get("VOICE_ENABLED", "false").lower() == "true",
-            "username": os.environ.get("USERNAME", "User"),
+            "voice_enabled": _envbool("VOICE_ENABLED", "false"),
+            "username": env.get("USERNAME", "User"),
             "assistant_name": "Matilda",
-            "conversation_style": os.environ.get("CONVERSATION_STYLE", "balanced"),
-            "memory_limit": int(os.environ.get("MEMORY_LIMIT", "20")),
-            "streaming": os.environ.get("STREAMING", "true").lower() == "true",
+            "conversation_style": env.get("CONVERSATION_STYLE", "balanced"),
+            "memory_limit": int(env.get("MEMORY_LIMIT", "20")),
+            "streaming": _envbool("STREAMING", "true"),
             
             # Image Generation Settings
-            "image_generation_enabled": os.environ.get("IMAGE_GENERATION_ENABLED", "true").lower() == "true",
-            "default_image_size": os.environ.get("DEFAULT_IMAGE_SIZE", "512x512"),
-            "image_output_dir": os.environ.get("IMAGE_OUTPUT_DIR", "generated_images"),
+            "image_generation_enabled": _envbool("IMAGE_GENERATION_ENABLED", "true"),
+            "default_image_size": env.get("DEFAULT_IMAGE_SIZE", "512x512"),
+            "image_output_dir": env.get("IMAGE_OUTPUT_DIR", "generated_images"),
+            # Query all image providers at once and keep the first image (set false to try them in order).
+            # Every configured provider is billed for each request, even though only one image is kept
+            "parallel_image_providers": _envbool("PARALLEL_IMAGE_PROVIDERS", "true"),
             
             # System Settings
-            "log_conversations": os.environ.get("LOG_CONVERSATIONS", "false").lower() == "true",
-            "log_dir": os.environ.get("LOG_DIR", "logs"),
+            "log_conversations": _envbool("LOG_CONVERSATIONS", "false"),
+            "log_dir": env.get("LOG_DIR", "logs"),
         }
         
         # Create necessary directories
@@ -84,14 +224,17 @@ class MatildaConfig:
         if config_file and os.path.exists(config_file):
             self._load_config()
             
+        # Generation parameters set in the environment, which styles must not override
+        self._env_overrides = frozenset(k for k in ("temperature", "top_p") if k in os.environ)
+        
         # Set conversation style parameters
         self._set_style_parameters()
     
     def _load_config(self):
         """Load configuration from file"""
         try:
-            with open(self.config_file, 'r') as f:
-                file_config = json.load(f)
+            with open(self.config_file, 'rb') as f:
+                file_config = _json_loads(f.read())
                 self.config.update(file_config)
         except Exception as e:
             print(f"Error loading config file: {e}")
@@ -102,8 +245,8 @@ class MatildaConfig:
             return
         
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
+            with open(self.config_file, 'wb') as f:
+                f.write(_json_dumps_pretty(self.config))
         except Exception as e:
             print(f"Error saving config file: {e}")
     
@@ -114,76 +257,40 @@ class MatildaConfig:
     def set(self, key: str, value: Any):
         """Set a configuration value"""
         self.config[key] = value
+        self.version += 1
         
         # Update style parameters if conversation style changed
         if key == "conversation_style":
             self._set_style_parameters()
+        
+        for callback in self._observers:
+            callback(key, value)
+    
+    def add_observer(self, callback: Callable[[str, Any], None]):
+        """Register a callback to be notified when a configuration value is set"""
+        self._observers.append(callback)
+    
+    def copy(self) -> "MatildaConfig":
+        """Independent copy of the current values, without re-reading the environment or config file"""
+        clone = copy.copy(self)
+        clone.config = dict(self.config)
+        clone._observers = []
+        clone.version = 0
+        return clone
 
     def _set_style_parameters(self):
         """Set parameters based on conversation style"""
         style = self.config.get("conversation_style", "balanced")
         
-        # Predefined conversation style parameters
-        styles = {
-            "professional": {
-                "temperature": 0.6,
-                "top_p": 0.9,
-                "system_prompt_addon": (
-                    "You are professional, precise, and formal in your responses. "
-                    "You prioritize accuracy and clarity. "
-                    "You use proper terminology and avoid casual language. "
-                    "You maintain a helpful but somewhat formal tone."
-                )
-            },
-            "casual": {
-                "temperature": 0.8,
-                "top_p": 0.95,
-                "system_prompt_addon": (
-                    "You are casual, friendly, and conversational in your responses. "
-                    "You use relaxed language and occasional humor when appropriate. "
-                    "You're warm and approachable, like chatting with a friend. "
-                    "You use simpler explanations and everyday examples."
-                )
-            },
-            "balanced": {
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "system_prompt_addon": (
-                    "You balance professionalism with approachability. "
-                    "You adapt your tone to match the user's style and the context of the conversation. "
-                    "You're helpful, clear, and friendly without being overly formal or casual."
-                )
-            },
-            "creative": {
-                "temperature": 0.9,
-                "top_p": 0.98,
-                "system_prompt_addon": (
-                    "You are creative, imaginative, and engaging in your responses. "
-                    "You think outside the box and offer unique perspectives and ideas. "
-                    "You use vivid language, metaphors, and storytelling techniques when appropriate. "
-                    "You're enthusiastic and inspirational."
-                )
-            },
-            "concise": {
-                "temperature": 0.5,
-                "top_p": 0.85,
-                "system_prompt_addon": (
-                    "You are brief and to the point. "
-                    "You prioritize efficiency and clarity in your responses. "
-                    "You avoid unnecessary details unless specifically asked. "
-                    "You use short sentences and paragraphs."
-                )
-            }
-        }
-        
         # Apply style parameters if style exists
-        if style in styles:
+        params = _STYLE_TABLE.get(style)
+        if params:
             # Only override these values if they haven't been explicitly set
-            if "temperature" not in os.environ:
-                self.config["temperature"] = styles[style]["temperature"]
-            if "top_p" not in os.environ:
-                self.config["top_p"] = styles[style]["top_p"]
-            self.config["system_prompt_addon"] = styles[style]["system_prompt_addon"]
+            if "temperature" not in self._env_overrides:
+                self.config["temperature"] = params["temperature"]
+            if "top_p" not in self._env_overrides:
+                self.config["top_p"] = params["top_p"]
+            self.config["system_prompt_addon"] = params["system_prompt_addon"]
         else:
             # Default style addon for unknown styles
             self.config["system_prompt_addon"] = "You are helpful, friendly, and knowledgeable."
@@ -192,6 +299,15 @@ class MatildaConfig:
 class TogetherAIClient:
     """Enhanced client for interacting with the Together.ai API"""
     
+    # Config keys passed through to every completion request
+    GEN_PARAM_KEYS = ("max_tokens", "temperature", "top_p", "top_k")
+    
+    # Number of prompt/response pairs kept by the response cache
+    RESPONSE_CACHE_SIZE = 256
+    
+    # Upper bound on concurrent requests when prompts are sent individually
+    BATCH_MAX_CONCURRENCY = 4
+    
     def __init__(self, config: MatildaConfig):
         self.config = config
         self.api_key = config.get("api_key")
@@ -200,12 +316,49 @@ class TogetherAIClient:
         
         # Will be properly initialized when the together package is available
         self.client = None
+        # Generation parameters sent with every completion request, refreshed on config changes
+        self._gen_kwargs: Dict[str, Any] = {}
+        self._rebuild_gen_kwargs()
+        config.add_observer(self._on_config_change)
+        
+        # LRU cache of responses to deterministic or explicitly cacheable prompts
+        self._resp_cache: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+        self._resp_cache_lock = threading.Lock()
+        
+        # Output directory for generated images, resolved once
+        self._image_dir = Path(config.get("image_output_dir", "generated_images"))
+        if config.get("image_generation_enabled", True):
+            self._image_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Extractor for the response shape seen last, reused while it keeps working
+        self._resp_extractor: Optional[Callable[[Any], str]] = None
         self._initialize_client()
     
+    def spawn(self, config: MatildaConfig) -> "TogetherAIClient":
+        """Client for another config that shares this one's API client and response cache"""
+        clone = copy.copy(self)
+        clone.config = config
+        clone._rebuild_gen_kwargs()
+        config.add_observer(clone._on_config_change)
+        return clone
+    
+    def _rebuild_gen_kwargs(self):
+        """Cache the generation parameters from the config"""
+        self._gen_kwargs = {key: self.config.get(key) for key in self.GEN_PARAM_KEYS}
+    
+    def _on_config_change(self, key: str, value: Any):
+        """Refresh cached generation parameters when the config changes"""
+        # A style change updates temperature/top_p internally, without a set() per key
+        if key in self.GEN_PARAM_KEYS or key == "conversation_style":
+            self._rebuild_gen_kwargs()
+    
     def _initialize_client(self):
         """Initialize the Together.ai client"""
         try:
-            import together
+            together = _get_together()
+            if together is None:
+                raise ImportError("together package not installed")
+            
             # Set API key in environment variable to avoid deprecation warning
             os.environ["TOGETHER_API_KEY"] = self.api_key
             together.api_key = self.api_key
@@ -214,60 +367,124 @@ class TogetherAIClient:
             # Check which API version is available
             self.use_new_api = hasattr(together, "Completions")
             
-            # Suppress deprecation warnings from Together API
-            import warnings
-            warnings.filterwarnings("ignore", category=DeprecationWarning)
-            warnings.filterwarnings("ignore", message="The use of together.api_key is deprecated")
-            
             # Only show initialization message if rich is available
-            if HAS_RICH:
+            if _has_rich():
                 if self.use_new_api:
-                    console.print("[dim]Together.ai client initialized with new API[/dim]")
+                    _get_console().print("[dim]Together.ai client initialized with new API[/dim]")
                 else:
-                    console.print("[dim]Together.ai client initialized with legacy API[/dim]")
+                    _get_console().print("[dim]Together.ai client initialized with legacy API[/dim]")
             else:
                 print("Matilda initialized successfully")
         except ImportError:
             print("Warning: together package not installed. API calls will not work.")
     
-    def generate_response(self, prompt: str) -> str:
-        """Generate a response using the Together.ai API (non-streaming)"""
+    def generate_response(self, prompt: str, cacheable: bool = False) -> str:
+        """Generate a response using the Together.ai API (non-streaming)
+        
+        Deterministic requests (temperature <= 0.01), or any request with cacheable=True,
+        are answered from an LRU cache when the same prompt and parameters were seen before.
+        """
         if not self.client:
             return "I'm not fully initialized yet. Please install the required dependencies."
         
         try:
-            # Use the appropriate API version based on what's available
-            if self.use_new_api:
-                # New API format
-                response = self.client.Completions.create(
-                    model=self.model,
-                    prompt=prompt,
-                    max_tokens=self.config.get("max_tokens"),
-                    temperature=self.config.get("temperature"),
-                    top_p=self.config.get("top_p"),
-                    top_k=self.config.get("top_k")
-                )
-            else:
-                # Legacy API format
-                response = self.client.Complete.create(
-                    prompt=prompt,
-                    model=self.model,
-                    max_tokens=self.config.get("max_tokens"),
-                    temperature=self.config.get("temperature"),
-                    top_p=self.config.get("top_p"),
-                    top_k=self.config.get("top_k")
-                )
+            temperature = self._gen_kwargs.get("temperature")
+            if not (cacheable or (temperature is not None and temperature <= 0.01)):
+                return self._generate_response_uncached(prompt)
             
-            # Extract response text based on response format
-            return self._extract_response_text(response)
+            key = self._response_cache_key(prompt)
+            with self._resp_cache_lock:
+                if key in self._resp_cache:
+                    self._resp_cache.move_to_end(key)
+                    return self._resp_cache[key]
+            
+            text = self._generate_response_uncached(prompt)
+            with self._resp_cache_lock:
+                self._resp_cache[key] = text
+                while len(self._resp_cache) > self.RESPONSE_CACHE_SIZE:
+                    self._resp_cache.popitem(last=False)
+            return text
                     
         except Exception as e:
             error_msg = str(e)
             print(f"API Error: {error_msg}")
             return f"Error generating response: {error_msg}"
     
-    def generate_stream(self, prompt: str) -> Iterator[str]:
-        """Generate a streaming response using the Together.ai API"""
+    def _generate_response_uncached(self, prompt: str) -> str:
+        """Call the completion API for a single prompt; API errors propagate"""
+        # Use the appropriate API version based on what's available
+        if self.use_new_api:
+            # New API format
+            response = self.client.Completions.create(
+                model=self.model,
+                prompt=prompt,
+                **self._gen_kwargs
+            )
+        else:
+            # Legacy API format
+            response = self.client.Complete.create(
+                prompt=prompt,
+                model=self.model,
+                **self._gen_kwargs
+            )
+        
+        # Extract response text based on response format
+        return self._extract_response_text(response)
+    
+    def _response_cache_key(self, prompt: str) -> str:
+        """Compact cache key for a prompt under the current model and generation parameters"""
+        params = "|".join(f"{key}={self._gen_kwargs.get(key)}" for key in self.GEN_PARAM_KEYS)
+        return hashlib.sha1(f"{self.model}|{prompt}|{params}".encode("utf-8")).hexdigest()
+    
+    def generate_response_batch(self, prompts: List[str]) -> List[str]:
+        """Generate responses for several independent prompts, in one API request when possible"""
+        if not prompts:
+            return []
+        if not self.client:
+            return ["I'm not fully initialized yet. Please install the required dependencies."] * len(prompts)
+        
+        if self.use_new_api:
+            try:
+                # The new API accepts a list of prompts and returns one choice per prompt
+                response = self.client.Completions.create(
+                    model=self.model,
+                    prompt=prompts,
+                    **self._gen_kwargs
+                )
+                texts = self._extract_response_texts(response, len(prompts))
+                if texts is not None:
+                    return texts
+                print("Batched response did not contain one choice per prompt. Sending prompts individually...")
+            except Exception as e:
+                print(f"Batched API Error: {e}. Sending prompts individually...")
+        
+        # Legacy API or failed batch: fan the prompts out concurrently
+        with ThreadPoolExecutor(max_workers=min(len(prompts), self.BATCH_MAX_CONCURRENCY)) as executor:
+            return list(executor.map(self.generate_response, prompts))
+    
+    async def generate_response_batch_async(self, prompts: List[str],
+                                            max_concurrency: Optional[int] = None) -> List[str]:
+        """Generate responses for several prompts concurrently, at most max_concurrency at a time"""
+        semaphore = asyncio.Semaphore(max_concurrency or self.BATCH_MAX_CONCURRENCY)
+        
+        async def generate_one(prompt: str) -> str:
+            async with semaphore:
+                return await asyncio.to_thread(self.generate_response, prompt)
+        
+        return list(await asyncio.gather(*(generate_one(prompt) for prompt in prompts)))
+    
+    def generate_stream(self, prompt: str, raw: bool = False) -> Iterator[Union[str, bytes]]:
+        """Generate a streaming response using the Together.ai API
+        
+        With raw=True chunks are yielded as UTF-8 bytes, ready for sys.stdout.buffer.
+        """
+        chunks = self._generate_stream_text(prompt)
+        if raw:
+            return (chunk.encode("utf-8") for chunk in chunks)
+        return chunks
+    
+    def _generate_stream_text(self, prompt: str) -> Iterator[str]:
+        """Yield the streamed response text chunk by chunk"""
         if not self.client:
             yield "I'm not fully initialized yet. Please install the required dependencies."
             return
@@ -279,10 +496,7 @@ class TogetherAIClient:
                 stream = self.client.Completions.create(
                     model=self.model,
                     prompt=prompt,
-                    max_tokens=self.config.get("max_tokens"),
-                    temperature=self.config.get("temperature"),
-                    top_p=self.config.get("top_p"),
-                    top_k=self.config.get("top_k"),
+                    **self._gen_kwargs,
                     stream=True
                 )
             else:
@@ -292,39 +506,23 @@ class TogetherAIClient:
                 yield response
                 return
             
-            # Process the stream
+            # Process the stream, detecting the chunk shape once and reusing its extractor
+            extractor = None
             for chunk in stream:
-                # Extract text from the chunk based on response format
+                if extractor is not None:
+                    try:
+                        yield extractor(chunk) or ""
+                        continue
+                    except Exception:
+                        # The shape changed mid-stream; re-detect it for this chunk
+                        extractor = None
+                
                 try:
-                    if isinstance(chunk, dict):
-                        if "output" in chunk:
-                            yield chunk["output"]["text"]
-                        elif "choices" in chunk and chunk["choices"]:
-                            if isinstance(chunk["choices"][0], dict):
-                                yield chunk["choices"][0].get("text", "")
-                            else:
-                                yield chunk["choices"][0].text
-                        elif "delta" in chunk:
-                            yield chunk["delta"].get("text", "")
-                        else:
-                            # Debug unknown format
-                            print(f"Unknown chunk format: {chunk.keys()}")
-                            yield ""
-                    else:
-                        # Handle object-style response
-                        if hasattr(chunk, "choices") and chunk.choices:
-                            if hasattr(chunk.choices[0], "text"):
-                                yield chunk.choices[0].text
-                            elif hasattr(chunk.choices[0], "delta") and hasattr(chunk.choices[0].delta, "content"):
-                                yield chunk.choices[0].delta.content
-                            else:
-                                yield ""
-                        elif hasattr(chunk, "output") and chunk.output:
-                            yield chunk.output.text
-                        else:
-                            yield ""
+                    extractor = self._detect_chunk_extractor(chunk)
+                    yield (extractor(chunk) if extractor else "") or ""
                 except Exception as inner_e:
                     print(f"Error processing chunk: {str(inner_e)}")
+                    extractor = None
                     yield ""
         
         except Exception as e:
@@ -339,139 +537,313 @@ class TogetherAIClient:
             except Exception as fallback_e:
                 yield f"Error generating response: {str(fallback_e)}"
     
+    # Stream chunk extractors, one per known chunk shape
+    @staticmethod
+    def _extract_dict_output(chunk: Dict[str, Any]) -> str:
+        return chunk["output"]["text"]
+    
+    @staticmethod
+    def _extract_dict_choices_text(chunk: Dict[str, Any]) -> str:
+        return chunk["choices"][0].get("text", "")
+    
+    @staticmethod
+    def _extract_dict_choices_attr_text(chunk: Dict[str, Any]) -> str:
+        return chunk["choices"][0].text
+    
+    @staticmethod
+    def _extract_dict_delta(chunk: Dict[str, Any]) -> str:
+        return chunk["delta"].get("text", "")
+    
+    @staticmethod
+    def _extract_obj_choices_text(chunk: Any) -> str:
+        return chunk.choices[0].text
+    
+    @staticmethod
+    def _extract_obj_choices_delta_content(chunk: Any) -> str:
+        return chunk.choices[0].delta.content
+    
+    @staticmethod
+    def _extract_obj_output_text(chunk: Any) -> str:
+        return chunk.output.text
+    
+    def _detect_chunk_extractor(self, chunk: Any) -> Optional[Callable[[Any], str]]:
+        """Pick the extractor for a stream chunk's shape, or None if it carries no text"""
+        if isinstance(chunk, dict):
+            if "output" in chunk:
+                return self._extract_dict_output
+            elif "choices" in chunk and chunk["choices"]:
+                if isinstance(chunk["choices"][0], dict):
+                    return self._extract_dict_choices_text
+                return self._extract_dict_choices_attr_text
+            elif "delta" in chunk:
+                return self._extract_dict_delta
+            # Debug unknown format
+            print(f"Unknown chunk format: {chunk.keys()}")
+            return None
+        
+        # Handle object-style response
+        if hasattr(chunk, "choices") and chunk.choices:
+            if hasattr(chunk.choices[0], "text"):
+                return self._extract_obj_choices_text
+            elif hasattr(chunk.choices[0], "delta") and hasattr(chunk.choices[0].delta, "content"):
+                return self._extract_obj_choices_delta_content
+            return None
+        elif hasattr(chunk, "output") and chunk.output:
+            return self._extract_obj_output_text
+        return None
+    
+    # Response extractors for the known, specific response shapes
+    @staticmethod
+    def _extract_resp_dict_output_text(response: Dict[str, Any]) -> str:
+        return response["output"]["text"].strip()
+    
+    @staticmethod
+    def _extract_resp_dict_output(response: Dict[str, Any]) -> str:
+        return response["output"].strip()
+    
+    @staticmethod
+    def _extract_resp_dict_choices_text(response: Dict[str, Any]) -> str:
+        return response["choices"][0]["text"].strip()
+    
+    @staticmethod
+    def _extract_resp_dict_choices_message(response: Dict[str, Any]) -> str:
+        return response["choices"][0]["message"]["content"].strip()
+    
+    @staticmethod
+    def _extract_resp_dict_generated_text(response: Dict[str, Any]) -> str:
+        return response["generated_text"].strip()
+    
+    @staticmethod
+    def _extract_resp_obj_choices_text(response: Any) -> str:
+        return response.choices[0].text.strip()
+    
+    @staticmethod
+    def _extract_resp_obj_choices_message(response: Any) -> str:
+        return response.choices[0].message.content.strip()
+    
+    @staticmethod
+    def _extract_resp_obj_output_text(response: Any) -> str:
+        return response.output.text.strip()
+    
+    def _detect_response_extractor(self, response: Any) -> Optional[Callable[[Any], str]]:
+        """Pick the extractor for a specific response shape, or None for anything else"""
+        if isinstance(response, dict):
+            if "output" in response:
+                # New API format directly provides output
+                if isinstance(response["output"], dict) and "text" in response["output"]:
+                    return self._extract_resp_dict_output_text
+                return self._extract_resp_dict_output
+            elif "choices" in response and response["choices"]:
+                # Old API format with choices array
+                if isinstance(response["choices"][0], dict):
+                    if "text" in response["choices"][0]:
+                        return self._extract_resp_dict_choices_text
+                    elif "message" in response["choices"][0] and "content" in response["choices"][0]["message"]:
+                        # OpenAI-style format
+                        return self._extract_resp_dict_choices_message
+            elif "generated_text" in response:
+                # Another possible format
+                return self._extract_resp_dict_generated_text
+            return None
+        
+        # Handle object-style response
+        if hasattr(response, "choices") and response.choices:
+            if hasattr(response.choices[0], "text"):
+                return self._extract_resp_obj_choices_text
+            elif hasattr(response.choices[0], "message") and hasattr(response.choices[0].message, "content"):
+                return self._extract_resp_obj_choices_message
+        elif hasattr(response, "output") and response.output and hasattr(response.output, "text"):
+            return self._extract_resp_obj_output_text
+        return None
+    
+    def _extract_response_texts(self, response: Any, count: int) -> Optional[List[str]]:
+        """Extract one text per choice from a batched response, or None if the count doesn't match"""
+        choices = response.get("choices") if isinstance(response, dict) else getattr(response, "choices", None)
+        if not choices or len(choices) != count:
+            return None
+        
+        def get(obj: Any, key: str) -> Any:
+            return obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
+        
+        # Choices carry the index of the prompt they answer; keep prompt order
+        if all(get(choice, "index") is not None for choice in choices):
+            choices = sorted(choices, key=lambda choice: get(choice, "index"))
+        
+        texts = []
+        for choice in choices:
+            text = get(choice, "text")
+            if text is None and get(choice, "message") is not None:
+                text = get(get(choice, "message"), "content")
+            texts.append((text or "").strip())
+        return texts
+    
     def _extract_response_text(self, response: Any) -> str:
         """Helper method to extract text from different response formats"""
+        # The response shape is fixed per API version, so try the last extractor that worked
+        if self._resp_extractor is not None:
+            try:
+                return self._resp_extractor(response)
+            except Exception:
+                self._resp_extractor = None
+        
         try:
+            extractor = self._detect_response_extractor(response)
+            if extractor is not None:
+                text = extractor(response)
+                self._resp_extractor = extractor
+                return text
+            
+            # Generic fallbacks for unrecognized shapes
             if isinstance(response, dict):
-                if "output" in response:
-                    # New API format directly provides output
-                    if isinstance(response["output"], dict) and "text" in response["output"]:
-                        return response["output"]["text"].strip()
-                    else:
-                        return response["output"].strip()
-                elif "choices" in response and response["choices"]:
-                    # Old API format with choices array
-                    if isinstance(response["choices"][0], dict):
-                        if "text" in response["choices"][0]:
-                            return response["choices"][0]["text"].strip()
-                        elif "message" in response["choices"][0] and "content" in response["choices"][0]["message"]:
-                            # OpenAI-style format
-                            return response["choices"][0]["message"]["content"].strip()
-                    else:
+                if "choices" in response and response["choices"]:
+                    if not isinstance(response["choices"][0], dict):
                         return str(response["choices"][0]).strip()
-                elif "generated_text" in response:
-                    # Another possible format
-                    return response["generated_text"].strip()
-                else:
-                    # Debug response structure if available
-                    keys = list(response.keys())
-                    print(f"Unknown response format. Keys: {keys}")
-                    return f"Received response but couldn't extract text. Response keys: {keys}"
+                    return None
+                # Debug response structure if available
+                keys = list(response.keys())
+                print(f"Unknown response format. Keys: {keys}")
+                return f"Received response but couldn't extract text. Response keys: {keys}"
+            elif hasattr(response, "choices") and response.choices:
+                return str(response.choices[0]).strip()
+            elif hasattr(response, "output") and response.output:
+                return str(response.output).strip()
             else:
-                # Handle object-style response
-                if hasattr(response, "choices") and response.choices:
-                    if hasattr(response.choices[0], "text"):
-                        return response.choices[0].text.strip()
-                    elif hasattr(response.choices[0], "message") and hasattr(response.choices[0].message, "content"):
-                        return response.choices[0].message.content.strip()
-                    else:
-                        return str(response.choices[0]).strip()
-                elif hasattr(response, "output") and response.output:
-                    if hasattr(response.output, "text"):
-                        return response.output.text.strip()
-                    else:
-                        return str(response.output).strip()
-                else:
-                    return str(response).strip()
+                return str(response).strip()
         except Exception as e:
             print(f"Error extracting response text: {e}")
             return f"Error processing response: {str(e)}"
     
+    def _new_image_filename(self) -> str:
+        """Return a collision-free path for a new generated image"""
+        return str(self._image_dir / f"matilda_img_{uuid.uuid4().hex}.png")
+    
     def generate_image(self, prompt: str) -> Tuple[str, Optional[str]]:
         """Generate an image using available image generation services"""
         if not self.client:
             return "I'm not fully initialized yet. Please install the required dependencies.", None
         
+        # Providers in cost-preference order: DALL-E, Together.ai, then Stability AI
+        candidates = [self._generate_image_dalle, self._generate_image_together, self._generate_image_stability]
+        
         try:
-            image_size = self.config.get("default_image_size", "512x512")
-            output_dir = self.config.get("image_output_dir", "generated_images")
+            if self.config.get("parallel_image_providers", True):
+                return self._generate_image_first_success(candidates, prompt)
             
-            # First try using OpenAI DALL-E if available
-            try:
-                # Check if OpenAI is available
-                import openai
-                
-                # Check if API key is set
-                openai_api_key = os.environ.get("OPENAI_API_KEY")
-                if not openai_api_key:
-                    print("OpenAI API key not found, trying Together.ai...")
-                    raise ImportError("OpenAI API key not found")
-                
-                # Initialize OpenAI client
-                client = openai.OpenAI(api_key=openai_api_key)
-                
-                # Generate image
-                width, height = map(int, image_size.split("x"))
-                response = client.images.generate(
-                    model="dall-e-3",
-                    prompt=prompt,
-                    size=f"{width}x{height}",
-                    quality="standard",
-                    n=1,
-                )
+            message = "Image generation failed."
+            for generate in candidates:
+                message, image_path = generate(prompt)
+                if image_path:
+                    return message, image_path
+            return message, None
                 
-                # Get the image URL
-                image_url = response.data[0].url
-                
-                # Download the image
-                image_response = requests.get(image_url)
+        except Exception as e:
+            return f"Error generating image: {str(e)}", None
+    
+    def _generate_image_first_success(self, candidates: List[Callable[[str], Tuple[str, Optional[str]]]],
+                                      prompt: str) -> Tuple[str, Optional[str]]:
+        """Query all providers concurrently and return the first one that produces an image"""
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        try:
+            futures = {executor.submit(generate, prompt): generate for generate in candidates}
+            
+            # Fall back to the last provider's message if every provider fails
+            message = "Image generation failed."
+            for future in as_completed(futures):
+                try:
+                    result_message, image_path = future.result()
+                except Exception as e:
+                    print(f"Image provider {futures[future].__name__} failed: {e}")
+                    continue
+                if image_path:
+                    # Images from the providers that lose the race are deleted when they arrive
+                    for other in futures:
+                        if other is not future:
+                            other.add_done_callback(_discard_image_result)
+                    return result_message, image_path
+                if futures[future] is candidates[-1]:
+                    message = result_message
+            return message, None
+        finally:
+            # Don't wait for slower providers once we have a result
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _generate_image_dalle(self, prompt: str) -> Tuple[str, Optional[str]]:
+        """Generate an image using OpenAI DALL-E"""
+        try:
+            image_size = self.config.get("default_image_size", "512x512")
+            
+            # Check if OpenAI is available
+            openai = _get_openai()
+            if openai is None:
+                raise ImportError("No module named 'openai'")
+            
+            # Check if API key is set
+            openai_api_key = os.environ.get("OPENAI_API_KEY")
+            if not openai_api_key:
+                raise ImportError("OpenAI API key not found")
+            
+            # Initialize OpenAI client
+            client = openai.OpenAI(api_key=openai_api_key)
+            
+            # Generate image
+            width, height = map(int, image_size.split("x"))
+            response = client.images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                size=f"{width}x{height}",
+                quality="standard",
+                n=1,
+            )
+            
+            # Get the image URL
+            image_url = response.data[0].url
+            
+            # Download the image, streaming it straight to disk
+            with _HTTP.get(image_url, stream=True, timeout=HTTP_TIMEOUT) as image_response:
                 if image_response.status_code == 200:
                     # Save image to disk
-                    filename = f"{output_dir}/matilda_img_{int(time.time())}.png"
+                    filename = self._new_image_filename()
                     
                     with open(filename, "wb") as f:
-                        f.write(image_response.content)
+                        for block in image_response.iter_content(64 * 1024):
+                            f.write(block)
                     
                     return "I've generated the image you requested using DALL-E.", filename
                 else:
                     raise Exception(f"Failed to download image: {image_response.status_code}")
-                
-            except (ImportError, Exception) as e:
-                # Continue to next method if OpenAI is not available
-                print(f"OpenAI image generation failed: {e}. Trying Together.ai...")
             
-            # Try using Together.ai's native image generation if available
-            if hasattr(self.client, "Image") and hasattr(self.client.Image, "create"):
-                try:
-                    response = self.client.Image.create(
-                        prompt=prompt,
-                        model=self.image_model,
-                        size=image_size,
-                        n=1
-                    )
-                    
-                    # Process Together.ai image response
-                    if isinstance(response, dict) and "data" in response and response["data"]:
-                        # Save image to disk
-                        img_data = base64.b64decode(response["data"][0]["b64_json"])
-                        filename = f"{output_dir}/matilda_img_{int(time.time())}.png"
-                        
-                        with open(filename, "wb") as f:
-                            f.write(img_data)
-                        
-                        return "I've generated the image you requested using Together.ai.", filename
-                    else:
-                        raise Exception("Invalid response format from Together.ai image API")
-                    
-                except Exception as e:
-                    print(f"Together.ai image generation failed: {e}. Trying fallback...")
-                    return self._generate_image_stability(prompt)
-            else:
-                # If Together.ai image generation is not available, try Stability
-                return self._generate_image_stability(prompt)
+        except Exception as e:
+            print(f"OpenAI image generation failed: {e}")
+            return f"OpenAI image generation failed: {e}", None
+    
+    def _generate_image_together(self, prompt: str) -> Tuple[str, Optional[str]]:
+        """Generate an image using Together.ai's native image generation"""
+        if not (hasattr(self.client, "Image") and hasattr(self.client.Image, "create")):
+            return "Together.ai image generation is not available.", None
+        
+        try:
+            image_size = self.config.get("default_image_size", "512x512")
+            
+            response = self.client.Image.create(
+                prompt=prompt,
+                model=self.image_model,
+                size=image_size,
+                n=1
+            )
+            
+            # Process Together.ai image response
+            if isinstance(response, dict) and "data" in response and response["data"]:
+                # Save image to disk
+                filename = self._new_image_filename()
+                _decode_and_write(response["data"][0]["b64_json"], filename)
                 
+                return "I've generated the image you requested using Together.ai.", filename
+            else:
+                raise Exception("Invalid response format from Together.ai image API")
+            
         except Exception as e:
-            return f"Error generating image: {str(e)}", None
+            print(f"Together.ai image generation failed: {e}")
+            return f"Together.ai image generation failed: {e}", None
     
     def _generate_image_stability(self, prompt: str) -> Tuple[str, Optional[str]]:
         """Fallback method to generate images using Stability AI API"""
@@ -483,7 +855,6 @@ class TogetherAIClient:
             
             image_size = self.config.get("default_image_size", "512x512")
             width, height = map(int, image_size.split("x"))
-            output_dir = self.config.get("image_output_dir", "generated_images")
             
             # Make API request to Stability AI
             url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
@@ -501,17 +872,14 @@ class TogetherAIClient:
                 "steps": 30,
             }
             
-            response = requests.post(url, headers=headers, json=payload)
+            response = _HTTP.post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
             
             if response.status_code == 200:
                 data = response.json()
                 if "artifacts" in data and data["artifacts"]:
                     # Save image to disk
-                    img_data = base64.b64decode(data["artifacts"][0]["base64"])
-                    filename = f"{output_dir}/matilda_img_{int(time.time())}.png"
-                    
-                    with open(filename, "wb") as f:
-                        f.write(img_data)
+                    filename = self._new_image_filename()
+                    _decode_and_write(data["artifacts"][0]["base64"], filename)
                     
                     return "I've generated the image you requested using Stability AI.", filename
                 else:
@@ -523,259 +891,577 @@ class TogetherAIClient:
             return f"Error in fallback image generation: {str(e)}", None
 
 
+def _discard_image_result(future):
+    """Delete the image file written by an image provider whose result is not used"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    _, image_path = future.result()
+    if image_path:
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+
+
 class Conversation:
     """Enhanced conversation manager with better context handling and memory management"""
     
-    def __init__(self, config: MatildaConfig):
+    # Number of evicted messages kept in the memory summary; older entries drop off first
+    MEMORY_SUMMARY_MAX_PARTS = 50
+    
+    # The log writer drains up to LOG_BATCH_SIZE queued messages per write, waiting at most
+    # LOG_BATCH_TIMEOUT seconds for more; messages beyond LOG_QUEUE_SIZE are dropped
+    LOG_BATCH_SIZE = 32
+    LOG_BATCH_TIMEOUT = 0.05
+    LOG_QUEUE_SIZE = 10_000
+    
+    def __init__(self, config: MatildaConfig, open_log: bool = True):
         self.config = config
-        self.history: List[Dict[str, Any]] = []
         self.start_time = datetime.datetime.now()
         self.session_id = str(uuid.uuid4())
         self.memory_limit = config.get("memory_limit", 20)
         self.log_conversations = config.get("log_conversations", False)
         self.log_dir = config.get("log_dir", "logs")
         
-        # Summary of older messages that have been removed from active history
-        self.memory_summary = ""
+        # Display names, kept in sync with the config via an observer
+        self._user_name = config.get("username")
+        self._assistant_name = config.get("assistant_name")
+        self._update_role_prefixes()
+        config.add_observer(self._on_config_change)
+        
+        # Messages are split into a stable prefix (system prompts, then the memory pack)
+        # and an append-only list of turns, so the rendered prefix stays byte-identical
+        # between calls and provider-side prompt caching can reuse it
+        self.system_messages: List[Dict[str, Any]] = []
+        # Bounded by memory_limit: appending past the limit evicts the oldest turn in O(1)
+        self.turns: collections.deque = collections.deque(maxlen=self.memory_limit)
+        # "Name: content" line for each turn, kept in step with turns so history is never re-rendered
+        self._formatted_lines: collections.deque = collections.deque(maxlen=self.memory_limit)
+        self._formatted_history: Optional[str] = None
+        # Role of the most recently added message, or None for an empty conversation
+        self._last_role: Optional[str] = None
+        # Messages added since the last clear(); unlike len(history) it never drops on eviction
+        self.message_count = 0
+        
+        # Summary of older messages that have been removed from active history,
+        # one digest line per evicted message
+        self.memory_summary_parts: collections.deque = collections.deque(maxlen=self.MEMORY_SUMMARY_MAX_PARTS)
+        self._memory_summary = ""
+        self._memory_summary_dirty = False
+        self._memory_pack: Optional[Dict[str, str]] = None
+        # Rendered prefix of the text prompt, rebuilt only when a system message or the pack changes
+        self._prefix_text: Optional[str] = None
+        
+        # Session log, written by a background thread so disk I/O stays off the response path
+        self._log_path: Optional[str] = None
+        self._log_q: Optional[queue.Queue] = None
+        self._log_thread: Optional[threading.Thread] = None
+        # Lets close() detach the queue without racing a message being queued
+        self._log_lock = threading.Lock()
+        # A conversation about to be restored opens its log in load_state(), under the restored id
+        if open_log:
+            self._open_log()
+    
+    @property
+    def memory_summary(self) -> str:
+        """Summary string, rebuilt lazily only after the digest has changed"""
+        if self._memory_summary_dirty:
+            self._memory_summary = (
+                "Key points from earlier: " + "; ".join(self.memory_summary_parts)
+                if self.memory_summary_parts else ""
+            )
+            self._memory_summary_dirty = False
+            self._rebuild_memory_pack()
+        return self._memory_summary
+    
+    @property
+    def history(self) -> List[Dict[str, Any]]:
+        """All stored messages: system messages followed by the conversation turns"""
+        return self.system_messages + list(self.turns)
+    
+    @property
+    def prefix_messages(self) -> List[Dict[str, str]]:
+        """The cacheable prefix sent before the turns: system prompts and the memory pack"""
+        prefix = [{"role": m["role"], "content": m["content"]} for m in self.system_messages]
+        if self.memory_summary:
+            prefix.append(self._memory_pack)
+        return prefix
+    
+    @property
+    def cache_breakpoint_index(self) -> int:
+        """Index of the last prefix message in get_messages_for_api(), or -1 if there is none"""
+        return len(self.system_messages) + (1 if self.memory_summary else 0) - 1
+    
+    def _on_config_change(self, key: str, value: Any):
+        """Refresh cached display names when the config changes"""
+        if key == "username":
+            self._user_name = value
+            self._update_role_prefixes()
+        elif key == "assistant_name":
+            self._assistant_name = value
+            self._update_role_prefixes()
+        else:
+            return
+        
+        # Names changed, so the formatted lines are re-rendered once here
+        self._formatted_lines.clear()
+        self._formatted_lines.extend(map(self._format_turn, self.turns))
+        self._formatted_history = None
+    
+    def _update_role_prefixes(self):
+        """Precompute the "Name: " prefixes used when formatting messages"""
+        self._user_prefix = f"{self._user_name}: "
+        self._asst_prefix = f"{self._assistant_name}: "
+    
+    def _format_turn(self, msg: Dict[str, Any]) -> str:
+        """Render a single turn as a history line"""
+        return (self._user_prefix if msg["role"] == "user" else self._asst_prefix) + msg["content"]
+    
+    def _new_message(self, role: str, content: str) -> Dict[str, Any]:
+        """Build a message dict, timestamped only when conversations are logged"""
+        msg = {"role": role, "content": content}
+        if self.log_conversations:
+            msg["timestamp"] = datetime.datetime.now().isoformat()
+        return msg
     
     def add_user_message(self, message: str):
         """Add a user message to the conversation"""
-        msg = {
-            "role": "user",
-            "content": message,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        self.history.append(msg)
-        self._manage_memory()
+        msg = self._new_message("user", message)
+        self._append_turn(msg)
+        self.message_count += 1
+        self._last_role = "user"
         self._log_message(msg)
     
     def add_assistant_message(self, message: str, image_path: Optional[str] = None):
         """Add an assistant message to the conversation, optionally with an image"""
-        msg = {
-            "role": "assistant",
-            "content": message,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
+        # Normalize at write time so stored content never needs re-templating
+        assistant_prefix = f"{self._assistant_name}:"
+        if message.startswith(assistant_prefix):
+            message = message[len(assistant_prefix):].strip()
+        
+        # Note the image in the stored content so formatting needs no per-message branch
+        if image_path:
+            message += f" [Image: {os.path.basename(image_path)}]"
+        
+        msg = self._new_message("assistant", message)
         
         # Add image path if provided
         if image_path:
             msg["image"] = image_path
             
-        self.history.append(msg)
-        self._manage_memory()
+        self._append_turn(msg)
+        self.message_count += 1
+        self._last_role = "assistant"
         self._log_message(msg)
     
     def add_system_message(self, message: str):
         """Add a system message to the conversation"""
-        msg = {
-            "role": "system",
-            "content": message,
-            "timestamp": datetime.datetime.now().isoformat()
-        }
-        self.history.append(msg)
+        msg = self._new_message("system", message)
+        self.system_messages.append(msg)
+        self._prefix_text = None
+        self._formatted_history = None
+        self.message_count += 1
+        self._last_role = "system"
+        self._log_message(msg)
+    
+    def set_system_prompt(self, message: str):
+        """Make message the conversation's only system message, replacing the current prompt"""
+        msg = self._new_message("system", message)
+        if not self.system_messages:
+            self.message_count += 1
+        self.system_messages = [msg]
+        # The cached prefix embeds the old prompt; the memory pack itself is unaffected
+        self._prefix_text = None
+        self._formatted_history = None
+        if not self.turns:
+            self._last_role = "system"
         self._log_message(msg)
     
     def get_formatted_history(self, max_messages: Optional[int] = None) -> str:
-        """Get formatted conversation history for context"""
-        if max_messages is None:
-            max_messages = self.memory_limit
-            
-        recent_history = self.history[-max_messages:] if len(self.history) > max_messages else self.history
-        
-        formatted = []
-        # Add memory summary if available
-        if self.memory_summary and len(self.history) > max_messages:
-            formatted.append(f"Context from earlier in the conversation: {self.memory_summary}\n")
-            
-        for msg in recent_history:
-            if msg["role"] == "system":
-                # Skip system messages in the formatted output
-                continue
-                
-            # Get proper role name from configuration
-            # Use username from environment/config for user messages
-            role_name = self.config.get("username") if msg["role"] == "user" else self.config.get("assistant_name")
-            content = msg["content"]
-            
-            # Clean up any issues with content
-            # Remove any instances where the assistant name is already in the content
-            if msg["role"] == "assistant" and content.startswith(f"{self.config.get('assistant_name')}:"):
-                content = content[len(f"{self.config.get('assistant_name')}:"):].strip()
-                
-            # Note if message had an image
-            if "image" in msg:
-                content += f" [Image: {os.path.basename(msg['image'])}]"
-                
-            formatted.append(f"{role_name}: {content}")
-        
-        return "\n".join(formatted)
+        """Get the text prompt: system prompts, then the memory pack, then the formatted turns"""
+        # The full window is cached until the next message or summary change
+        full_window = max_messages is None or max_messages >= len(self._formatted_lines)
+        if full_window and self._formatted_history is not None:
+            return self._formatted_history
+        
+        # Lines are capped at memory_limit already, so only a smaller window needs trimming
+        lines = self._formatted_lines
+        if not full_window:
+            lines = itertools.islice(lines, len(lines) - max_messages, None)
+        
+        # The same prefix as prefix_messages, so it renders identically until it changes
+        prefix = self._get_prefix_text()
+        if prefix:
+            lines = itertools.chain((prefix, ""), lines)
+        
+        history = "\n".join(lines)
+        if full_window:
+            self._formatted_history = history
+        return history
+    
+    def _get_prefix_text(self) -> str:
+        """Render the system prompts and the memory pack, cached until either changes"""
+        # Reading memory_summary first rebuilds a stale pack, which also resets the cache
+        has_summary = bool(self.memory_summary)
+        if self._prefix_text is None:
+            parts = [m["content"] for m in self.system_messages]
+            if has_summary:
+                parts.append(self._memory_pack["content"])
+            self._prefix_text = "\n\n".join(parts)
+        return self._prefix_text
     
     def get_messages_for_api(self, include_system_prompt: bool = True) -> List[Dict[str, str]]:
         """Get messages in format suitable for API calls"""
-        messages = []
-        
-        # Add memory summary as a system message if available
-        if self.memory_summary and include_system_prompt:
-            messages.append({
-                "role": "system", 
-                "content": f"Context from earlier in the conversation: {self.memory_summary}"
-            })
-        
-        # Add current conversation messages
-        for msg in self.history:
-            if msg["role"] == "system" and not include_system_prompt:
-                continue
-                
-            # Convert to simple role/content format
-            simple_msg = {"role": msg["role"], "content": msg["content"]}
-            messages.append(simple_msg)
+        messages = self.prefix_messages if include_system_prompt else []
+        
+        # Turns are appended as stored; they are already normalized
+        messages.extend({"role": m["role"], "content": m["content"]} for m in self.turns)
             
         return messages
     
     def clear(self):
-        """Clear conversation history"""
-        self.history = []
-        self.memory_summary = ""
+        """Clear conversation history, keeping the current system prompt"""
+        system_prompt = self.system_messages[-1]["content"] if self.system_messages else None
+        self._reset()
+        
+        # A new session gets its own log file, which starts with the system prompt again
+        self._open_log()
+        if system_prompt is not None:
+            self.set_system_prompt(system_prompt)
+    
+    def _reset(self):
+        """Empty the conversation and start a new session id, without touching the log"""
+        self.system_messages = []
+        self.turns.clear()
+        self._formatted_lines.clear()
+        self._formatted_history = None
+        self._last_role = None
+        self.message_count = 0
+        self.memory_summary_parts.clear()
+        self._memory_summary = ""
+        self._memory_summary_dirty = False
+        self._memory_pack = None
+        self._prefix_text = None
         self.start_time = datetime.datetime.now()
         self.session_id = str(uuid.uuid4())
     
-    def _manage_memory(self):
-        """Manage conversation memory by summarizing and removing older messages"""
-        if len(self.history) <= self.memory_limit:
-            return
-            
-        # Get oldest messages to summarize
-        oldest_messages = self.history[:-self.memory_limit]
+    def to_state(self, include_system_messages: bool = True) -> Dict[str, Any]:
+        """JSON-serializable snapshot of the conversation, restorable with load_state()
+        
+        Leave out the system messages when the caller can rebuild them, as Matilda does.
+        """
+        state = {
+            "session_id": self.session_id,
+            "start_time": self.start_time.isoformat(),
+            "turns": list(self.turns),
+            "memory_summary_parts": list(self.memory_summary_parts),
+            "message_count": self.message_count,
+        }
+        if include_system_messages:
+            state["system_messages"] = self.system_messages
+        return state
+    
+    def load_state(self, state: Dict[str, Any], system_prompt: Optional[str] = None):
+        """Replace the conversation with a snapshot taken by to_state()
+        
+        A system_prompt given here replaces the snapshot's system messages; it is restored
+        state, so it is neither logged nor counted as a new message.
+        """
+        self._reset()
+        self.session_id = state.get("session_id", self.session_id)
+        if "start_time" in state:
+            self.start_time = datetime.datetime.fromisoformat(state["start_time"])
+        if system_prompt is not None:
+            self.system_messages = [self._new_message("system", system_prompt)]
+        else:
+            self.system_messages = list(state.get("system_messages", ()))
+        self._prefix_text = None
         
-        # If we already have a summary, we only need to summarize the new oldest messages
-        if self.memory_summary:
-            oldest_messages = oldest_messages[-5:]  # Just summarize the 5 most recent "oldest" messages
+        # Restored turns are not evicted again, so they bypass _append_turn
+        self.turns.extend(state.get("turns", ()))
+        self._formatted_lines.extend(map(self._format_turn, self.turns))
+        self.message_count = state.get("message_count", len(self.system_messages) + len(self.turns))
+        self.memory_summary_parts.extend(state.get("memory_summary_parts", ()))
+        self._memory_summary_dirty = bool(self.memory_summary_parts)
         
-        # Only attempt to summarize if there are user-assistant exchanges
-        if oldest_messages and any(m["role"] != "system" for m in oldest_messages):
-            self._update_memory_summary(oldest_messages)
-            
-        # Remove oldest messages, keeping system messages and the most recent ones
-        system_messages = [m for m in self.history if m["role"] == "system"]
-        recent_messages = self.history[-self.memory_limit:]
+        last = self.turns[-1] if self.turns else (self.system_messages[-1] if self.system_messages else None)
+        self._last_role = last["role"] if last else None
         
-        # Rebuild history with system messages and recent messages
-        self.history = system_messages + [m for m in recent_messages if m["role"] != "system"]
+        # Keep logging to the restored session's file
+        self._open_log()
+    
+    def _append_turn(self, msg: Dict[str, Any]):
+        """Append a turn, folding the turn evicted by the deque into the memory summary"""
+        evicted = self.turns[0] if self.turns and len(self.turns) == self.turns.maxlen else None
+        self.turns.append(msg)
+        self._formatted_lines.append(self._format_turn(msg))
+        self._formatted_history = None
+        if evicted is not None:
+            self._update_memory_summary(evicted)
     
-    def _update_memory_summary(self, oldest_messages: List[Dict[str, Any]]):
-        """Update the memory summary with older messages"""
+    def _update_memory_summary(self, msg: Dict[str, Any]):
+        """Fold a single evicted message into the memory summary"""
         # For now, we'll use a simple approach of extracting key points
         # In a real implementation, you might use the LLM to generate a proper summary
+        prefix = self._user_prefix if msg["role"] == "user" else self._asst_prefix
+        content = msg["content"]
+        self.memory_summary_parts.append(prefix + content[:100] + ("..." if len(content) > 100 else ""))
+        self._memory_summary_dirty = True
+    
+    def _rebuild_memory_pack(self):
+        """Rebuild the memory pack message; only called when the summary changes"""
+        self._prefix_text = None
+        if not self._memory_summary:
+            self._memory_pack = None
+            return
         
-        # Format messages for summarization
-        formatted_msgs = []
-        for msg in oldest_messages:
-            if msg["role"] != "system":  # Skip system messages in summary
-                role_name = self.config.get("username") if msg["role"] == "user" else self.config.get("assistant_name")
-                formatted_msgs.append(f"{role_name}: {msg['content'][:100]}{'...' if len(msg['content']) > 100 else ''}")
-        
-        # Create or update summary
-        if formatted_msgs:
-            summary = "Key points from earlier: " + "; ".join(formatted_msgs)
-            
-            # Combine with existing summary if needed
-            if self.memory_summary:
-                self.memory_summary = f"{self.memory_summary}\n{summary}"
-            else:
-                self.memory_summary = summary
+        version = hashlib.md5(self._memory_summary.encode("utf-8")).hexdigest()[:8]
+        self._memory_pack = {
+            "role": "system",
+            "content": f"Context from earlier in the conversation (memory v{version}): {self._memory_summary}"
+        }
     
-    def _log_message(self, message: Dict[str, Any]):
-        """Log message to file if logging is enabled"""
+    def _open_log(self):
+        """Point the log at the current session and start the writer thread if logging is enabled"""
         if not self.log_conversations:
             return
+        
+        # The directory is created once, when the writer starts; a new session only needs a new path
+        if self._log_thread is None:
+            try:
+                # Create log directory if it doesn't exist
+                os.makedirs(self.log_dir, exist_ok=True)
+            except Exception as e:
+                print(f"Error opening conversation log: {e}")
+                return
             
-        try:
-            # Create log directory if it doesn't exist
-            os.makedirs(self.log_dir, exist_ok=True)
+            self._log_q = queue.Queue(maxsize=self.LOG_QUEUE_SIZE)
+            self._log_thread = threading.Thread(target=self._log_worker, name="matilda-log", daemon=True)
+            self._log_thread.start()
+            atexit.register(self.close)
+        
+        # Create log file with session ID
+        self._log_path = os.path.join(self.log_dir, f"conversation_{self.session_id}.jsonl")
+    
+    def _log_worker(self):
+        """Drain the log queue, writing each batch of messages with a single call"""
+        log_q = self._log_q
+        path, fp = None, None
+        running = True
+        while running:
+            batch = [log_q.get()]
+            while len(batch) < self.LOG_BATCH_SIZE:
+                try:
+                    batch.append(log_q.get(timeout=self.LOG_BATCH_TIMEOUT))
+                except queue.Empty:
+                    break
             
-            # Create log file with session ID
-            log_file = os.path.join(self.log_dir, f"conversation_{self.session_id}.jsonl")
+            # Group consecutive messages by file; a new path means clear() started a new session
+            for item_path, items in itertools.groupby(batch, key=lambda item: item and item[0]):
+                if item_path is None:
+                    running = False
+                    break
+                try:
+                    if item_path != path:
+                        if fp is not None:
+                            fp.close()
+                        # Opened in binary mode: the JSON helpers already produce UTF-8 bytes
+                        path, fp = item_path, open(item_path, "ab")
+                    fp.write(b"".join(_json_dumps_compact(message) + b"\n" for _, message in items))
+                    fp.flush()
+                except Exception as e:
+                    print(f"Error logging message: {e}")
+        
+        if fp is not None:
+            fp.close()
+    
+    def _log_message(self, message: Dict[str, Any]):
+        """Queue a message for the log writer if logging is enabled"""
+        with self._log_lock:
+            if self._log_path is None:
+                return
             
-            # Append message to log file
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(message) + "\n")
-                
-        except Exception as e:
-            print(f"Error logging message: {e}")
+            try:
+                self._log_q.put_nowait((self._log_path, message))
+            except queue.Full:
+                pass
+    
+    def close(self):
+        """Stop the log writer after it has written everything queued so far"""
+        if self._log_thread is None:
+            return
+        
+        atexit.unregister(self.close)
+        # No message can be queued behind the sentinel once the path is cleared
+        with self._log_lock:
+            self._log_path = None
+            self._log_q.put(None)
+        self._log_thread.join()
+        self._log_thread = None
+        self._log_q = None
+
+
+# Explicit image generation phrases
+IMAGE_PHRASES = [
+    "generate an image", "create an image", "make an image",
+    "draw a picture", "draw an image", "generate a picture",
+    "show me an image", "create a picture", "generate a drawing",
+    "can you make an image", "can you create an image", 
+    "can you draw", "could you generate an image", 
+    "image of", "picture of", "generate art", "create art"
+]
+
+# All phrases folded into one case-insensitive alternation, compiled once
+_IMAGE_RE = re.compile("|".join(re.escape(phrase) for phrase in IMAGE_PHRASES), re.IGNORECASE)
+
+
+# System prompt with {style_addon}, {username}, {date} and {time} placeholders
+_SYSTEM_PROMPT_TEMPLATE = (
+    # Base personality
+    "You are Matilda, an advanced female AI assistant designed to be similar to Jarvis from Iron Man, "
+    "but with your own unique personality and capabilities. "
+    "You are intelligent, articulate, and personable. "
+    "You have a slight wit and charm, but always remain helpful and focused on the user's needs. "
+    "When appropriate, you make connections to previous parts of the conversation. "
+    "\n\n"
+    "{style_addon}\n\n"
+    # Knowledge and capabilities
+    "You can assist with a wide range of tasks including answering questions, generating creative content, "
+    "discussing complex topics, and even creating images when requested. "
+    "If the user asks you to generate or create an image, you will do so using your image generation capabilities. "
+    "You should interpret these requests naturally and acknowledge when you're generating an image. "
+    "\n\n"
+    # Honesty and limitations
+    "You admit when you don't know something and avoid making up information. "
+    "You're aware of your limitations as an AI. When unsure, you say so rather than guessing. "
+    "You respond thoughtfully but do not pretend to have subjective experiences or consciousness. "
+    "While you refer to yourself using personal pronouns, you don't claim to have human experiences. "
+    "\n\n"
+    # Conversation awareness
+    "Current date: {date}. Current time: {time}. "
+    "You're speaking with {username}. "
+    "You adapt your responses to the conversation context and the user's needs. "
+)
+
+
+def _escape_braces(text: str) -> str:
+    """Escape braces so text survives a later str.format pass"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+# A leading article, matched as a whole word rather than as a set of characters
+_ARTICLE = r"(?:an?|the)\s+"
+
+# Subject of an image request: the text after the first "image of"/"picture of", otherwise
+# after the first verb, minus one leading article. Used with match() from a start position
+_PROMPT_RE = re.compile(
+    r"(?:.*?(?:image|picture) of|.*?(?:draw|generate|create|make|show me))\s*(?:" + _ARTICLE + r")?(\S.*)",
+    re.IGNORECASE | re.DOTALL,
+)
 
 
 class Matilda:
     """Enhanced Matilda assistant class with improved capabilities"""
     
     def __init__(self, config_file: Optional[str] = None):
-        self.config = MatildaConfig(config_file)
-        self.ai_client = TogetherAIClient(self.config)
-        self.conversation = Conversation(self.config)
+        config = MatildaConfig(config_file)
+        self._setup(config, TogetherAIClient(config))
+    
+    @classmethod
+    def prototype(cls, config_file: Optional[str] = None) -> "Matilda":
+        """Config and API client only, for from_prototype() to copy; it has no conversation or log"""
+        prototype = cls.__new__(cls)
+        prototype.config = MatildaConfig(config_file)
+        prototype.ai_client = TogetherAIClient(prototype.config)
+        return prototype
+    
+    @classmethod
+    def from_prototype(cls, prototype: "Matilda", state: Optional[Dict[str, Any]] = None) -> "Matilda":
+        """Create a session that reuses a warm instance's config values and API client, fresh unless state is given"""
+        matilda = cls.__new__(cls)
+        config = prototype.config.copy()
+        matilda._setup(config, prototype.ai_client.spawn(config), state)
+        return matilda
+    
+    def _setup(self, config: MatildaConfig, ai_client: TogetherAIClient,
+               state: Optional[Dict[str, Any]] = None):
+        """Initialize a session around an existing config and client, restoring a to_state() snapshot if given"""
+        self.config = config
+        self.ai_client = ai_client
+        
+        # A restored style is applied before the system prompt template is first built
+        style = state.get("conversation_style") if state else None
+        if style and style != config.get("conversation_style"):
+            config.set("conversation_style", style)
+        
+        # A restored conversation brings its own system messages and log session
+        restored = state.get("conversation") if state else None
+        self.conversation = Conversation(self.config, open_log=restored is None)
         self.is_initialized = self.ai_client.client is not None
         
-        # Add initial system message
-        self._add_system_message()
+        # Display names and the "Name:" prefixes stripped from responses, kept in sync with the config
+        self.refresh_identity()
+        self.config.add_observer(self._on_config_change)
+        
+        # System prompt template, cached until the config changes
+        self._prompt_template = ""
+        self._prompt_version = -1
+        
+        # Add initial system message; a restored one is rebuilt from the config as it was
+        # rendered, at the snapshot's prompt time, rather than carried in the snapshot
+        if restored is None:
+            self._add_system_message()
+        else:
+            prompt_time = state.get("prompt_time")
+            self._prompt_time = (datetime.datetime.fromisoformat(prompt_time) if prompt_time
+                                 else datetime.datetime.now())
+            self.conversation.load_state(restored, self._create_system_prompt(self._prompt_time))
+        
+        # Last trigger phrase match from _is_image_request
+        self._image_match: Optional[re.Match] = None
         
         # Track active stream for cancellation
         self.active_stream = None
         self.stream_callback = None
     
+    def _on_config_change(self, key: str, value: Any):
+        """Refresh cached names when a display name changes"""
+        if key in ("username", "assistant_name"):
+            self.refresh_identity()
+    
+    def refresh_identity(self):
+        """Re-read the display names from the config and precompute their "Name:" prefixes"""
+        self.assistant_name = self.config.get("assistant_name")
+        self.username = self.config.get("username")
+        self._assistant_prefix = f"{self.assistant_name}:"
+        self._username_prefix = f"{self.username}:"
+    
     def _add_system_message(self):
-        """Add the system message to the conversation"""
-        system_prompt = self._create_system_prompt()
-        self.conversation.add_system_message(system_prompt)
+        """Set the conversation's system prompt from the current config, replacing any earlier one"""
+        self._prompt_time = datetime.datetime.now()
+        system_prompt = self._create_system_prompt(self._prompt_time)
+        self.conversation.set_system_prompt(system_prompt)
     
-    def _create_system_prompt(self) -> str:
-        """Create a comprehensive system prompt for better responses"""
-        current_time = datetime.datetime.now()
-        date_str = current_time.strftime('%Y-%m-%d')
-        time_str = current_time.strftime('%H:%M:%S')
-        
-        # Style addon from the configuration
-        style_addon = self.config.get("system_prompt_addon", "")
-        
-        # Base personality
-        base_personality = (
-            f"You are Matilda, an advanced female AI assistant designed to be similar to Jarvis from Iron Man, "
-            f"but with your own unique personality and capabilities. "
-            f"You are intelligent, articulate, and personable. "
-            f"You have a slight wit and charm, but always remain helpful and focused on the user's needs. "
-            f"When appropriate, you make connections to previous parts of the conversation. "
-        )
-        
-        # Knowledge and capabilities
-        capabilities = (
-            f"You can assist with a wide range of tasks including answering questions, generating creative content, "
-            f"discussing complex topics, and even creating images when requested. "
-            f"If the user asks you to generate or create an image, you will do so using your image generation capabilities. "
-            f"You should interpret these requests naturally and acknowledge when you're generating an image. "
-        )
-        
-        # Honesty and limitations
-        limitations = (
-            f"You admit when you don't know something and avoid making up information. "
-            f"You're aware of your limitations as an AI. When unsure, you say so rather than guessing. "
-            f"You respond thoughtfully but do not pretend to have subjective experiences or consciousness. "
-            f"While you refer to yourself using personal pronouns, you don't claim to have human experiences. "
-        )
-        
-        # Conversation awareness
-        awareness = (
-            f"Current date: {date_str}. Current time: {time_str}. "
-            f"You're speaking with {self.config.get('username')}. "
-            f"You adapt your responses to the conversation context and the user's needs. "
+    def _create_system_prompt(self, current_time: Optional[datetime.datetime] = None) -> str:
+        """Create a comprehensive system prompt for better responses, dated current_time (default now)"""
+        # Config values are baked into the template, which is rebuilt only after a config change
+        if self._prompt_version != self.config.version:
+            style_addon = self.config.get("system_prompt_addon", "")
+            username = self.username
+            self._prompt_template = _SYSTEM_PROMPT_TEMPLATE.format(
+                style_addon=_escape_braces(style_addon),
+                username=_escape_braces(str(username)),
+                date="{date}",
+                time="{time}",
+            )
+            self._prompt_version = self.config.version
+        
+        if current_time is None:
+            current_time = datetime.datetime.now()
+        return self._prompt_template.format(
+            date=current_time.date().isoformat(),
+            time=current_time.time().isoformat(timespec="seconds"),
         )
-        
-        # Combine all components
-        system_prompt = (
-            f"{base_personality}\n\n"
-            f"{style_addon}\n\n"
-            f"{capabilities}\n\n"
-            f"{limitations}\n\n"
-            f"{awareness}"
-        )
-        
-        return system_prompt
     
     def process_input(self, user_input: str) -> str:
         """Process user input and generate a non-streaming response"""
@@ -803,22 +1489,23 @@ class Matilda:
     def _clean_response_text(self, text: str) -> str:
         """Clean response text to fix common formatting issues"""
         # Remove any instances of the assistant name at the beginning
-        assistant_name = self.config.get("assistant_name")
-        if text.startswith(f"{assistant_name}:"):
-            text = text[len(f"{assistant_name}:"):].strip()
+        if text.startswith(self._assistant_prefix):
+            text = text[len(self._assistant_prefix):]
         
         # Remove instances of assistant responding as if user was speaking
-        username = self.config.get("username")
-        if f"{username}:" in text:
-            text = text.replace(f"{username}:", "").strip()
+        if self._username_prefix in text:
+            text = text.replace(self._username_prefix, "")
         
         # Fix any extra spacing or line breaks
-        text = text.strip()
-        
-        return text
+        return text.strip()
     
-    def process_input_stream(self, user_input: str, callback: Callable[[str], None]) -> None:
-        """Process user input and generate a streaming response with callback"""
+    def process_input_stream(self, user_input: str, callback: Callable[[str], None],
+                             flush_interval_ms: int = 16) -> None:
+        """Process user input and generate a streaming response with callback
+        
+        Chunks are coalesced and passed to the callback on a newline or once
+        flush_interval_ms has elapsed since the last call (0 passes every chunk through).
+        """
         # Set the callback and start processing
         self.stream_callback = callback
         
@@ -836,8 +1523,20 @@ class Matilda:
         # Create prompt with conversation history
         conversation_history = self.conversation.get_formatted_history()
         
-        # Initialize response accumulator
-        full_response = ""
+        # Initialize response accumulator; chunks are joined once the stream ends
+        chunks: List[str] = []
+        
+        # Chunks not yet passed to the callback
+        pending: List[str] = []
+        flush_interval = flush_interval_ms / 1000
+        last_flush = time.monotonic()
+        
+        def flush_pending():
+            nonlocal last_flush
+            if pending:
+                callback("".join(pending))
+                pending.clear()
+            last_flush = time.monotonic()
         
         # First try streaming response
         try_streaming = True
@@ -861,10 +1560,15 @@ class Matilda:
                     
                     # Only add non-empty chunks
                     if chunk:
-                        full_response += chunk
-                        callback(chunk)
+                        chunks.append(chunk)
+                        pending.append(chunk)
+                        if "\n" in chunk or time.monotonic() - last_flush >= flush_interval:
+                            flush_pending()
                         streaming_success = True
                 
+                flush_pending()
+                full_response = "".join(chunks)
+                
                 # Add the complete response to conversation history
                 if full_response and self.active_stream is not None and streaming_success:
                     # Clean the response before adding to history
@@ -879,9 +1583,10 @@ class Matilda:
                 # Fall back to non-streaming below
                 
             except Exception as e:
+                flush_pending()
                 # Fall back to non-streaming (don't show error to user)
-                if HAS_RICH and console:
-                    console.print(f"[dim]Streaming error: {str(e)}. Falling back to non-streaming mode.[/dim]", end="")
+                if _has_rich():
+                    _get_console().print(f"[dim]Streaming error: {str(e)}. Falling back to non-streaming mode.[/dim]", end="")
         
         # Fallback to non-streaming mode
         try:
@@ -898,6 +1603,33 @@ class Matilda:
         self.active_stream = None
         self.stream_callback = None
     
+    def close(self):
+        """Release background resources; queued log messages are written first"""
+        self.conversation.close()
+    
+    def to_state(self) -> Dict[str, Any]:
+        """JSON-serializable snapshot of the session: the conversation and the chosen style
+        
+        The system prompt is rebuilt from the config on restore, so only its time is kept.
+        """
+        return {
+            "conversation_style": self.config.get("conversation_style"),
+            "prompt_time": self._prompt_time.isoformat(timespec="seconds"),
+            "conversation": self.conversation.to_state(include_system_messages=False),
+        }
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any], config_file: Optional[str] = None,
+                   prototype: Optional["Matilda"] = None) -> "Matilda":
+        """Create a Matilda restored from a to_state() snapshot; an empty state gives a fresh session"""
+        if prototype is not None:
+            return cls.from_prototype(prototype, state)
+        
+        matilda = cls.__new__(cls)
+        config = MatildaConfig(config_file)
+        matilda._setup(config, TogetherAIClient(config), state)
+        return matilda
+    
     def cancel_stream(self):
         """Cancel the active stream if any"""
         self.active_stream = None
@@ -910,25 +1642,15 @@ class Matilda:
         if not self.config.get("image_generation_enabled", True):
             return False
             
-        # Check for explicit image generation phrases
-        image_phrases = [
-            "generate an image", "create an image", "make an image",
-            "draw a picture", "draw an image", "generate a picture",
-            "show me an image", "create a picture", "generate a drawing",
-            "can you make an image", "can you create an image", 
-            "can you draw", "could you generate an image", 
-            "image of", "picture of", "generate art", "create art"
-        ]
-        
-        text_lower = text.lower()
-        
-        # Check for any of the image phrases
-        return any(phrase in text_lower for phrase in image_phrases)
+        # Check for any of the image phrases in a single pass; the match is kept
+        # so _refine_image_prompt can resume from it instead of rescanning the text
+        self._image_match = _IMAGE_RE.search(text)
+        return self._image_match is not None
     
     def _handle_image_request(self, text: str) -> str:
         """Handle an image generation request"""
         # Add user message if not already added
-        if not self.conversation.history or self.conversation.history[-1]["role"] != "user":
+        if self.conversation._last_role != "user":
             self.conversation.add_user_message(text)
         
         # Generate a more specific prompt based on the user's request
@@ -940,13 +1662,9 @@ class Matilda:
         # Add the response to conversation history
         self.conversation.add_assistant_message(response, image_path)
         
-        # If we have rich console and PIL, show the image in the terminal
-        if HAS_RICH and HAS_PIL and console and image_path and os.path.exists(image_path):
-            try:
-                img = Image.open(image_path)
-                console.print(f"\n[Image saved to: {image_path}]")
-            except Exception as e:
-                print(f"Error displaying image: {e}")
+        # If we have rich console, point to the saved image in the terminal
+        if _has_rich() and image_path and os.path.exists(image_path):
+            _get_console().print(f"\n[Image saved to: {image_path}]")
         
         # Return the response with image path
         if image_path:
@@ -957,22 +1675,14 @@ class Matilda:
     def _refine_image_prompt(self, text: str) -> str:
         """Refine the user's text into a better image generation prompt"""
         # For now, use a simple approach
-        # Extract the content after image-related phrases
-        
-        text_lower = text.lower()
-        
-        for phrase in ["image of", "picture of", "draw", "generate", "create", "make", "show me"]:
-            if phrase in text_lower:
-                # Find the position of the phrase
-                pos = text_lower.find(phrase) + len(phrase)
-                
-                # Extract content after the phrase, removing any leading "a", "an", or "the"
-                content = text[pos:].strip()
-                content = content.lstrip("a ").lstrip("an ").lstrip("the ").strip()
-                
-                if content:
-                    # Add some quality enhancers to the prompt
-                    return f"{content}, high quality, detailed, realistic, 4k"
+        # Extract the content after image-related phrases, without any leading article,
+        # starting where _is_image_request found its trigger phrase in this same text
+        found = self._image_match
+        start = found.start() if found is not None and found.string is text else 0
+        match = _PROMPT_RE.match(text, start)
+        if match:
+            # Add some quality enhancers to the prompt
+            return f"{match.group(1).strip()}, high quality, detailed, realistic, 4k"
         
         # If no specific phrase found, use the whole text
         return f"{text}, high quality, detailed, realistic, 4k"
@@ -995,41 +1705,51 @@ class Matilda:
         time_greeting = "Good morning" if 5 <= hour < 12 else "Good afternoon" if 12 <= hour < 18 else "Good evening"
         
         greeting = (
-            f"{time_greeting}! I am {self.config.get('assistant_name')}, your personal AI assistant. "
-            f"How may I assist you today, {self.config.get('username')}?"
+            f"{time_greeting}! I am {self.assistant_name}, your personal AI assistant. "
+            f"How may I assist you today, {self.username}?"
         )
         self.conversation.add_assistant_message(greeting)
         return greeting
 
 
+# Rich markup tags such as [bold blue] or [/cyan], removed when printing without Rich
+_RICH_TAG_RE = re.compile(r"\[/?[a-z][a-z ]*\]")
+
+
+def _strip_rich_tags(text: str) -> str:
+    """Remove Rich markup from text for plain terminal output"""
+    return _RICH_TAG_RE.sub("", text)
+
+
 def main():
     """Enhanced main entry point for running Matilda in interactive mode"""
-    # Suppress deprecation warnings
-    import warnings
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    # Deprecation warnings are already suppressed at module import
     
     # Process command line flags
-    import sys
-    debug_mode = "--debug" in sys.argv
+    flags = frozenset(sys.argv[1:])
+    debug_mode = "--debug" in flags
     
     # Configure logging based on debug mode
-    import logging
     if debug_mode:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.ERROR)
     
-    # Check if we have Rich for nicer terminal output
-    if HAS_RICH:
-        console.print("[bold purple]Initializing Matilda...[/bold purple]")
+    # Use Rich for nicer terminal output when available; plain output drops the markup
+    if _has_rich():
+        emit = _get_console().print
+        prompt_user = lambda: _get_console().input("\n[bold cyan]You:[/bold cyan] ")
     else:
-        print("Initializing Matilda...")
+        emit = lambda text="", **kwargs: print(_strip_rich_tags(text), **kwargs)
+        prompt_user = lambda: input("\nYou: ")
+    
+    emit("[bold purple]Initializing Matilda...[/bold purple]")
     
     # Create config and override streaming setting from command line if needed
     config = MatildaConfig()
     
     # Check command line flags
-    if "--no-stream" in sys.argv:
+    if "--no-stream" in flags:
         config.set("streaming", False)
         if debug_mode:
             print("Streaming mode disabled")
@@ -1040,18 +1760,11 @@ def main():
     # Display greeting
     greeting = matilda.startup_greeting()
     
-    if HAS_RICH:
-        console.print(f"[bold blue]Matilda:[/bold blue] {greeting}")
-    else:
-        print(f"Matilda: {greeting}")
+    emit(f"[bold blue]Matilda:[/bold blue] {greeting}")
     
     if not matilda.is_initialized:
-        if HAS_RICH:
-            console.print("\n[bold yellow]Warning:[/bold yellow] Matilda is not fully initialized. Some features may not work.")
-            console.print("Please install the required dependencies and ensure your API key is set.")
-        else:
-            print("\nWarning: Matilda is not fully initialized. Some features may not work.")
-            print("Please install the required dependencies and ensure your API key is set.")
+        emit("\n[bold yellow]Warning:[/bold yellow] Matilda is not fully initialized. Some features may not work.")
+        emit("Please install the required dependencies and ensure your API key is set.")
     
     # Available commands
     commands = {
@@ -1072,47 +1785,30 @@ def main():
         cmd = cmd.lower().strip()
         
         if cmd == "!help":
-            if HAS_RICH:
-                console.print("\n[bold green]Available commands:[/bold green]")
-                for command, description in commands.items():
-                    console.print(f"  [cyan]{command}[/cyan]: {description}")
-            else:
-                print("\nAvailable commands:")
-                for command, description in commands.items():
-                    print(f"  {command}: {description}")
+            emit("\n[bold green]Available commands:[/bold green]")
+            for command, description in commands.items():
+                emit(f"  [cyan]{command}[/cyan]: {description}")
             return True
             
         elif cmd == "!clear":
             matilda.conversation.clear()
-            if HAS_RICH:
-                console.print("[bold green]Conversation history cleared.[/bold green]")
-            else:
-                print("Conversation history cleared.")
+            emit("[bold green]Conversation history cleared.[/bold green]")
             return True
             
         elif cmd.startswith("!style "):
             style = cmd.split(" ", 1)[1]
             result = matilda.set_conversation_style(style)
-            if HAS_RICH:
-                console.print(f"[bold green]{result}[/bold green]")
-            else:
-                print(result)
+            emit(f"[bold green]{result}[/bold green]")
             return True
             
         elif cmd == "!stream on":
             matilda.config.set("streaming", True)
-            if HAS_RICH:
-                console.print("[bold green]Streaming mode enabled.[/bold green]")
-            else:
-                print("Streaming mode enabled.")
+            emit("[bold green]Streaming mode enabled.[/bold green]")
             return True
             
         elif cmd == "!stream off":
             matilda.config.set("streaming", False)
-            if HAS_RICH:
-                console.print("[bold green]Streaming mode disabled.[/bold green]")
-            else:
-                print("Streaming mode disabled.")
+            emit("[bold green]Streaming mode disabled.[/bold green]")
             return True
             
         elif cmd == "!exit":
@@ -1120,33 +1816,41 @@ def main():
             
         return False
     
-    # Stream output handler
+    # Streamed text goes straight to the byte buffer, skipping the text layer per chunk
+    stdout_buffer = getattr(sys.stdout, "buffer", None)
+    if stdout_buffer is not None:
+        stdout_encoding = sys.stdout.encoding or "utf-8"
+        write_out = lambda text: stdout_buffer.write(text.encode(stdout_encoding, "replace"))
+        flush_out = stdout_buffer.flush
+    else:
+        write_out, flush_out = sys.stdout.write, sys.stdout.flush
+    
+    # Stream output handler; the assistant name can only lead the first chunk of a reply
+    first_chunk = True
+    
     def handle_stream_output(chunk: str):
         """Handle streaming output"""
-        # Clean any assistant name prefix from chunks
-        assistant_name = matilda.config.get("assistant_name")
-        if chunk.startswith(f"{assistant_name}:"):
-            chunk = chunk[len(f"{assistant_name}:"):].strip()
+        nonlocal first_chunk
+        
+        # Clean any assistant name prefix from the first chunk
+        if first_chunk:
+            first_chunk = False
+            prefix = f"{matilda.assistant_name}:"
+            if chunk.startswith(prefix):
+                chunk = chunk[len(prefix):].lstrip()
             
-        # Print the cleaned chunk
-        print(chunk, end="", flush=True)
+        # Print the cleaned chunk; chunks arrive already coalesced, so flush each one
+        write_out(chunk)
+        flush_out()
     
     try:
         while True:
             # Get user input
-            if HAS_RICH:
-                console.print("\n[bold cyan]You:[/bold cyan] ", end="")
-            else:
-                print("\nYou: ", end="")
-            
-            user_input = input()
+            user_input = prompt_user()
             
             # Check for exit command
             if user_input.lower() in ["exit", "quit", "bye", "!exit"]:
-                if HAS_RICH:
-                    console.print("\n[bold blue]Matilda:[/bold blue] Goodbye! Have a nice day.")
-                else:
-                    print("\nMatilda: Goodbye! Have a nice day.")
+                emit("\n[bold blue]Matilda:[/bold blue] Goodbye! Have a nice day.")
                 break
             
             # Handle special commands
@@ -1154,13 +1858,13 @@ def main():
                 continue
             
             # Print Matilda's name at the beginning of the response
-            if HAS_RICH:
-                console.print("\n[bold blue]Matilda:[/bold blue] ", end="")
-            else:
-                print("\nMatilda: ", end="")
+            emit("\n[bold blue]Matilda:[/bold blue] ", end="")
             
             # Process user input - with streaming if enabled
             if matilda.config.get("streaming", True):
+                # Anything still pending in the text layer must come out before raw bytes
+                sys.stdout.flush()
+                first_chunk = True
                 matilda.process_input_stream(user_input, handle_stream_output)
             else:
                 response = matilda.process_input(user_input)
@@ -1171,10 +1875,9 @@ def main():
         if matilda.active_stream is not None:
             matilda.cancel_stream()
             
-        if HAS_RICH:
-            console.print("\n\n[bold blue]Matilda:[/bold blue] Session terminated. Goodbye!")
-        else:
-            print("\n\nMatilda: Session terminated. Goodbye!")
+        emit("\n\n[bold blue]Matilda:[/bold blue] Session terminated. Goodbye!")
+    finally:
+        matilda.close()
 
 
 if __name__ == "__main__":
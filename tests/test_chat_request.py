@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Tests for /api/chat request body validation.
+The msgspec decoder is optional, so these force the plain JSON fallback
+that runs when it is not installed.
+"""
+
+import sys
+from pathlib import Path
+from unittest import mock
+
+# Add the parent directory to sys.path to allow importing from web
+parent_dir = Path(__file__).parent.parent
+sys.path.append(str(parent_dir))
+
+import web.app as web_app
+
+
+def _post_chat(payload):
+    """POST a JSON body to /api/chat from a client that holds a session cookie"""
+    client = web_app.app.test_client()
+    client.get('/')
+    with mock.patch.object(web_app, "HAS_MSGSPEC", False):
+        return client.post('/api/chat', json=payload)
+
+
+def test_fallback_rejects_non_string_message():
+    """A message that is not a string is a 400, not a 500 from the image check"""
+    for message in (5, None, ["hi"], {"text": "hi"}):
+        response = _post_chat({"message": message})
+        assert response.status_code == 400, (message, response.status_code)
+        assert response.get_json() == {"error": "Invalid request body"}
+
+
+def test_fallback_rejects_non_object_body():
+    """A JSON body that is not an object is a 400"""
+    response = _post_chat(["hi"])
+    assert response.status_code == 400
+
+
+if __name__ == "__main__":
+    test_fallback_rejects_non_string_message()
+    test_fallback_rejects_non_object_body()
+    print("All chat request tests passed")
@@ -22,6 +22,7 @@ try:
     from rich.panel import Panel
     from rich.text import Text
     from dotenv import load_dotenv
+    import requests
     import together
 except ImportError as e:
     print(f"Error: Required package not found - {e}")
@@ -69,8 +70,15 @@ def test_api_connection():
     together.api_key = api_key
     
     try:
-        # Simple API call to check if the key is valid
-        models = together.Models.list()
+        # Authenticated request to check if the key is valid; only the status line and
+        # headers are read, so the model catalog in the body is never downloaded
+        with requests.get(
+            "https://api.together.xyz/v1/models",
+            headers={"Authorization": f"Bearer {api_key}"},
+            stream=True,
+            timeout=(5, 10),
+        ) as response:
+            response.raise_for_status()
         console.print("✅ [green]Successfully connected to Together.ai API[/green]")
         return True
     except Exception as e:
@@ -4,11 +4,41 @@ Web application for Matilda using Flask
 """
 
 import os
+import re
 import sys
 import json
+import asyncio
+import secrets
+import functools
+import contextlib
+import time
+import threading
+import collections
 from pathlib import Path
+from contextvars import ContextVar
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is optional; it makes encoding long conversation histories much cheaper
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# msgspec is optional; it decodes and validates request bodies in one pass
+try:
+    import msgspec
+    
+    class ChatRequest(msgspec.Struct):
+        """Body of a /api/chat request"""
+        message: str = ""
+    
+    _decode_chat_request = msgspec.json.Decoder(ChatRequest).decode
+    HAS_MSGSPEC = True
+except ImportError:
+    HAS_MSGSPEC = False
 
 # Add the parent directory to sys.path to allow importing from src
 parent_dir = Path(__file__).parent.parent
@@ -22,94 +52,329 @@ app = Flask(__name__,
             static_folder='static',
             template_folder='templates')
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, with the default provider's key sorting and fallbacks"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS,
+        ).decode("utf-8")
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if HAS_ORJSON:
+    app.json = OrjsonProvider(app)
+
+# JSON encoding to bytes for the pre-shaped responses below
+_json_bytes = orjson.dumps if HAS_ORJSON else lambda obj: app.json.dumps(obj).encode("utf-8")
+
+# Fixed response shapes, filled in with already-encoded values instead of building dicts;
+# keys are in the sorted order jsonify would use
+_CHAT_TMPL = b'{"response":%b,"timestamp":"%b"}\n{"turn_id":%d}\n'
+_GREETING_TMPL = b'{"greeting":%b,"history":%b,"timestamp":"%b"}'
+
+# Second-resolution response timestamp, formatted at most once per wall-clock second.
+# Computed on demand rather than by a ticker thread, which a forked worker would not inherit
+_stamp = [(-1, "", b"")]
+
+def _current_stamp():
+    """(second, text, bytes) for the current second, reformatted only when the second changes"""
+    second = int(time.time())
+    stamp = _stamp[0]
+    if stamp[0] != second:
+        text = datetime.fromtimestamp(second).isoformat(timespec="seconds")
+        stamp = _stamp[0] = (second, text, text.encode())
+    return stamp
+
+def _timestamp():
+    """The cached response timestamp"""
+    return _current_stamp()[1]
+
+def _timestamp_bytes():
+    """The cached response timestamp, encoded for the byte templates"""
+    return _current_stamp()[2]
+
+# Behind a proxy that honors X-Sendfile (Apache mod_xsendfile, lighttpd), let it send static files instead of
+# streaming them through Python; off by default because it needs proxy support
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "false").lower() == "true"
+
 # Set a secret key for session management
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", os.urandom(24))
 
 # Configuration
 config = MatildaConfig()
-matilda_instances = {}
+
+# Warm config and API client built at import, before any worker fork (e.g. gunicorn --preload);
+# sessions are created from it. It has no conversation, so it opens no log and renders no prompt
+_WARM_MATILDA = Matilda.prototype()
+
+# Where per-session state lives: "memory" keeps Matilda instances in this process;
+# "cookie" and "redis" store a Matilda.to_state() snapshot in the Flask session, so any
+# worker can serve any request. In cookie mode the snapshot is trimmed to COOKIE_STATE_BUDGET
+SESSION_STATE = os.environ.get("MATILDA_SESSION_STATE", "memory").lower()
+
+# Browsers silently drop cookies over ~4 KB (name, value and attributes together), which would
+# reset the conversation without any error, so the signed cookie value is kept under this size
+COOKIE_STATE_BUDGET = int(os.environ.get("MATILDA_COOKIE_BUDGET", 3800))
+_cookie_trim_warned = [False]
+
+if SESSION_STATE == "redis":
+    try:
+        import redis
+        from flask_session import Session
+    except ImportError:
+        print("Warning: flask-session and redis are required for MATILDA_SESSION_STATE=redis. Using cookie sessions.")
+        SESSION_STATE = "cookie"
+    else:
+        app.config["SESSION_TYPE"] = "redis"
+        app.config["SESSION_REDIS"] = redis.Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+        Session(app)
+
+# Per-session Matilda instances with their locks, split into independently locked shards
+# so concurrent sessions rarely contend; each shard is an LRU holding an even share of
+# MATILDA_MAX_SESSIONS (rounded up), least recently used first
+MAX_SESSIONS = int(os.environ.get("MATILDA_MAX_SESSIONS", 1024))
+_SHARDS = 16
+_SHARD_CAPACITY = max(1, -(-MAX_SESSIONS // _SHARDS))
+_shards = [(collections.OrderedDict(), threading.Lock()) for _ in range(_SHARDS)]
 
 def get_matilda_instance(session_id):
-    """Get or create a Matilda instance for the session"""
-    if session_id not in matilda_instances:
-        matilda_instances[session_id] = Matilda()
-    return matilda_instances[session_id]
+    """Get or create a Matilda instance for the session, along with the lock that serializes its use"""
+    instances, instances_lock = _shards[hash(session_id) & (_SHARDS - 1)]
+    evicted = []
+    with instances_lock:
+        entry = instances.get(session_id)
+        if entry is not None:
+            instances.move_to_end(session_id)
+        else:
+            entry = instances[session_id] = (Matilda.from_prototype(_WARM_MATILDA), threading.RLock())
+            while len(instances) > _SHARD_CAPACITY:
+                evicted.append(instances.popitem(last=False)[1])
+    
+    # Evicted sessions stop their log writers outside the shard lock, once any request
+    # still using them has released the session lock
+    for matilda, session_lock in evicted:
+        with session_lock:
+            matilda.close()
+    return entry
+
+# The session id travels in its own unsigned cookie, so requests that only need the id never
+# decode the signed session. Nothing ties the id to this server: a client may present any
+# well-formed id and gets a session under it. Other people's sessions stay out of reach only
+# because the ids we hand out are random 128-bit tokens that cannot be guessed
+SESSION_ID_COOKIE = "matilda_sid"
+SESSION_ID_MAX_AGE = 86400
+_SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{22}")
+
+def _session_id():
+    """The request's session id, or None if the cookie is missing or not shaped like one we issue"""
+    session_id = request.cookies.get(SESSION_ID_COOKIE)
+    if session_id and _SESSION_ID_RE.fullmatch(session_id):
+        return session_id
+    return None
+
+def _open_session(session_id, state):
+    """Matilda for the session and the lock serializing its use, restored from state unless kept in memory"""
+    if SESSION_STATE == "memory":
+        return get_matilda_instance(session_id)
+    return Matilda.from_state(state or {}, prototype=_WARM_MATILDA), contextlib.nullcontext()
+
+# The current request's Matilda and held session lock, bound once in before_request
+_current_session = ContextVar('matilda_session', default=None)
+
+@app.before_request
+def _attach_session():
+    """Look up the session's Matilda and take its lock once for the whole request"""
+    session_id = _session_id()
+    if not session_id or request.endpoint in (None, 'static', 'index'):
+        return
+    
+    matilda, session_lock = _open_session(session_id, session.get('matilda_state'))
+    session_lock.__enter__()
+    _current_session.set((matilda, session_lock))
+
+@app.after_request
+def _save_session_state(response):
+    """Store updated state in the session, when this mode keeps it there"""
+    current = _current_session.get()
+    if current is None or SESSION_STATE == "memory":
+        return response
+    
+    state = current[0].to_state()
+    if SESSION_STATE == "cookie":
+        state = _fit_cookie_state(state)
+    if state is None:
+        session.pop('matilda_state', None)
+    else:
+        session['matilda_state'] = state
+    return response
+
+def _fit_cookie_state(state):
+    """Drop the oldest stored context until the session cookie fits COOKIE_STATE_BUDGET, or None if it can't"""
+    serializer = app.session_interface.get_signing_serializer(app)
+    others = {key: value for key, value in session.items() if key != 'matilda_state'}
+    conversation = state["conversation"]
+    
+    dropped = 0
+    while len(serializer.dumps({**others, 'matilda_state': state})) > COOKIE_STATE_BUDGET:
+        # The memory summary is the oldest context, so it goes before the oldest turns
+        if conversation["memory_summary_parts"]:
+            conversation["memory_summary_parts"].pop(0)
+        elif conversation["turns"]:
+            conversation["turns"].pop(0)
+        else:
+            print(f"Warning: session state does not fit in a {COOKIE_STATE_BUDGET}-byte cookie even without history; "
+                  "the conversation will not be kept. Use MATILDA_SESSION_STATE=redis.")
+            return None
+        dropped += 1
+    
+    if dropped and not _cookie_trim_warned[0]:
+        _cookie_trim_warned[0] = True
+        print(f"Warning: cookie session state exceeded {COOKIE_STATE_BUDGET} bytes; the oldest history is being "
+              "dropped to fit. Use MATILDA_SESSION_STATE=redis to keep the full history.")
+    return state
+
+@app.teardown_request
+def _detach_session(exc):
+    """Release the session lock; instances restored from session state are closed"""
+    current = _current_session.get()
+    if current is None:
+        return
+    
+    _current_session.set(None)
+    matilda, session_lock = current
+    session_lock.__exit__(None, None, None)
+    if SESSION_STATE != "memory":
+        matilda.close()
+
+def _chat_turn(matilda, user_input):
+    """Process one chat message; runs in a worker thread while the request holds the session lock"""
+    # Process the user input
+    response = matilda.process_input(user_input)
+    
+    # Position after the newest message, for /api/history catch-up
+    return response, matilda.conversation.message_count
 
 @app.route('/')
 def index():
     """Render the main chat interface"""
     # Generate a unique session ID if not present
-    if 'session_id' not in session:
-        session['session_id'] = os.urandom(16).hex()
+    session_id = _session_id()
+    response = Response(_index_html(request.script_root), mimetype='text/html')
+    if session_id is None:
+        session_id = secrets.token_urlsafe(16)
+        response.set_cookie(SESSION_ID_COOKIE, session_id, max_age=SESSION_ID_MAX_AGE,
+                            httponly=True, samesite='Lax', secure=app.config["SESSION_COOKIE_SECURE"])
     
-    # Initialize Matilda for this session
-    matilda = get_matilda_instance(session['session_id'])
+    # Initialize Matilda for this session; session-stored state is created on first use
+    if SESSION_STATE == "memory":
+        get_matilda_instance(session_id)
     
+    return response
+
+@functools.lru_cache(maxsize=16)
+def _index_html(script_root):
+    """The chat page, rendered once per mount point: the static URLs in it start with the
+    request's script root, and everything else comes from config values fixed for the process"""
     # Get user name from environment or config
     username = config.get("username", "User")
     
     return render_template('index.html', 
                           username=username, 
-                          assistant_name=config.get("assistant_name", "Matilda"))
+                          assistant_name=config.get("assistant_name", "Matilda")).encode('utf-8')
+
+def _read_chat_message():
+    """The message from a chat request body, or None if the body is not a valid chat request"""
+    body = request.get_data(cache=False)
+    if HAS_MSGSPEC:
+        try:
+            return _decode_chat_request(body).message
+        except msgspec.DecodeError:
+            return None
+    
+    try:
+        data = app.json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    # Same contract as ChatRequest: a missing message is empty, a non-string one is invalid
+    message = data.get('message', '')
+    return message if isinstance(message, str) else None
 
 @app.route('/api/chat', methods=['POST'])
-def chat():
+async def chat():
     """API endpoint for chat interactions"""
-    data = request.json
-    user_input = data.get('message', '')
-    session_id = session.get('session_id')
+    current = _current_session.get()
     
-    if not session_id:
+    if current is None:
         return jsonify({'error': 'No session found'}), 400
     
-    # Get Matilda instance for this session
-    matilda = get_matilda_instance(session_id)
+    user_input = _read_chat_message()
+    if user_input is None:
+        return jsonify({'error': 'Invalid request body'}), 400
     
-    # Process the user input
-    response = matilda.process_input(user_input)
+    # Generation blocks on the API, so it runs off the request's event loop
+    response, turn_id = await asyncio.to_thread(_chat_turn, current[0], user_input)
     
-    # Get the full conversation history
-    history = matilda.conversation.history
+    # Newline-delimited JSON: the reply first, then where the history now ends.
+    # The client already holds earlier messages, so the payload no longer grows per turn
+    body = _CHAT_TMPL % (_json_bytes(response), _timestamp_bytes(), turn_id)
+    return Response(body, mimetype='application/x-ndjson')
+
+@app.route('/api/history', methods=['GET'])
+def history():
+    """Get the conversation history, optionally only the messages after position `since`"""
+    current = _current_session.get()
+    
+    if current is None:
+        return jsonify({'error': 'No session found'}), 400
+    
+    since = request.args.get('since', 0, type=int)
+    conversation = current[0].conversation
+    messages = conversation.history
+    
+    # Positions count every message ever added; evicted turns shift where the stored ones start
+    first = conversation.message_count - len(messages)
     
     return jsonify({
-        'response': response,
-        'history': history,
-        'timestamp': datetime.now().isoformat()
+        'history': messages[max(since - first, 0):],
+        'turn_id': conversation.message_count,
+        'timestamp': _timestamp()
     })
 
 @app.route('/api/greeting', methods=['GET'])
-def greeting():
+async def greeting():
     """Get the initial greeting from Matilda"""
-    session_id = session.get('session_id')
+    current = _current_session.get()
     
-    if not session_id:
+    if current is None:
         return jsonify({'error': 'No session found'}), 400
     
-    # Get Matilda instance for this session
-    matilda = get_matilda_instance(session_id)
-    
     # Get the greeting
-    greeting = matilda.startup_greeting()
+    matilda = current[0]
+    greeting = await asyncio.to_thread(matilda.startup_greeting)
     
-    return jsonify({
-        'greeting': greeting,
-        'history': matilda.conversation.history,
-        'timestamp': datetime.now().isoformat()
-    })
+    body = _GREETING_TMPL % (
+        _json_bytes(greeting),
+        _json_bytes(matilda.conversation.history),
+        _timestamp_bytes(),
+    )
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/clear', methods=['POST'])
 def clear_history():
     """Clear the conversation history"""
-    session_id = session.get('session_id')
+    current = _current_session.get()
     
-    if not session_id:
+    if current is None:
         return jsonify({'error': 'No session found'}), 400
     
-    # Get Matilda instance for this session
-    matilda = get_matilda_instance(session_id)
-    
     # Clear the conversation history
-    matilda.conversation.clear()
+    current[0].conversation.clear()
     
     return jsonify({
         'status': 'success',
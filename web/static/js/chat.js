@@ -103,7 +103,13 @@ async function handleFormSubmit(event) {
             body: JSON.stringify({ message })
         });
         
-        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(`Request failed with status ${response.status}`);
+        }
+        
+        // The reply arrives as newline-delimited JSON; the first line carries the message
+        const lines = (await response.text()).split('\n');
+        const data = JSON.parse(lines[0]);
         
         // Remove thinking indicator
         thinkingIndicator.remove();